@@ -33,7 +33,7 @@ def realStartup():
         Perform all the initialization stuff which is not mandatory to display the window
         This function should be called within the GTK main loop, once the window has been displayed
     """
-    import atexit, dbus.mainloop.glib, gui.about, modules, webbrowser
+    import atexit, dbus.mainloop.glib, gui.about, media, modules, webbrowser
 
     def onDelete(win, event):
         """ Use our own quit sequence, that will itself destroy the window """
@@ -57,6 +57,7 @@ def realStartup():
     def atExit():
         """ Final function, called just before exiting the Python interpreter """
         prefs.save()
+        media.tagCache.save()
         log.logger.info('Stopped')
 
     # D-Bus
@@ -148,6 +149,8 @@ gtk.glade.bindtextdomain(consts.appNameShort, consts.dirLocale)
 # Command line
 parser = optparse.OptionParser(usage='Usage: %prog [options] [FILE(s)]')
 parser.add_option('-p', '--playbin2', action='store_true', default=False, help='use the playbin2 GStreamer component (unstable)')
+parser.add_option('--preroll', type='float', default=4, metavar='SECONDS', help='prepare the next track SECONDS seconds before the end of the current one (default: %default)')
+parser.add_option('--crossfade', type='float', default=0, metavar='SECONDS', help='crossfade tracks during SECONDS seconds, not available with playbin2 (default: %default)')
 prefs.setCmdLine(parser.parse_args())
 
 # PyGTK initialization
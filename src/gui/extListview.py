@@ -16,7 +16,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 #
-# ExtListView v1.8
+# ExtListView v1.9
+#
+# v1.9:
+#   * A renderer may be given None as its type, its content being then provided by a cell data function instead of being stored in the list
+#   * Sort criteria may be functions returning the value to be used for a given row, instead of indexes
+#   * Sorting is based on keys, cached until the content of the list is modified
+#   * Switching between ascending/descending order only reverses the rows, without sorting them again
+#   * The mark is tracked with a gtk.TreeRowReference, the additional column used to find it has been removed
+#   * Removing/inserting many rows is done with the model detached from the view, and cropping no longer changes the selection first
+#   * The selection, the cursor, and the first visible row are restored once the model is attached again
+#   * Many rows inserted at a given position are appended and moved with a single reordering
 #
 # v1.8:
 #   * The 'extlistview-modified' signal was not generated when calling clear() and replaceContent()
@@ -53,7 +63,7 @@
 #   * Added a call to set_cursor() when unselecting all rows upon clicking on the empty area
 #   * Sort indicators are now displayed whenever needed
 
-import gtk, random
+import bisect, gtk, random
 
 from gtk     import gdk
 from gobject import signal_new, TYPE_INT, TYPE_STRING, TYPE_BOOLEAN, TYPE_PYOBJECT, TYPE_NONE, SIGNAL_RUN_LAST
@@ -63,6 +73,9 @@ from gobject import signal_new, TYPE_INT, TYPE_STRING, TYPE_BOOLEAN, TYPE_PYOBJE
 DND_REORDERING_ID   = 1024
 DND_INTERNAL_TARGET = ('extListview-internal', gtk.TARGET_SAME_WIDGET, DND_REORDERING_ID)
 
+# Beyond this number of modified rows, the model is detached from the view during the modification
+BULK_MIN_ROWS = 50
+
 
 # Custom signals
 signal_new('extlistview-dnd', gtk.TreeView, SIGNAL_RUN_LAST, TYPE_NONE, (gdk.DragContext, TYPE_INT, TYPE_INT, gtk.SelectionData, TYPE_INT, TYPE_PYOBJECT))
@@ -112,6 +125,9 @@ class ExtListView(gtk.TreeView):
             Note that for the latter, the identifier 1024 must not be used (internally used for reordering)
 
             If useMarkup is True, the 'markup' attributes is used instead of 'text' for CellRendererTexts
+
+            A renderer with None as its type is not associated with any data, a cell data function must then be set on its column
+            A sort criterion is either the index of some data, or a function returning the value to be used for a given row
         """
         gtk.TreeView.__init__(self)
 
@@ -120,7 +136,8 @@ class ExtListView(gtk.TreeView):
         # Sorting rows
         self.sortLastCol     = None   # The last column used for sorting (needed to switch between ascending/descending)
         self.sortAscending   = True   # Ascending or descending order
-        self.sortColCriteria = {}     # For each column, store the tuple of indexes used to sort the rows
+        self.sortColCriteria = {}     # For each column, store the tuple of criteria used to sort the rows
+        self.sortKeys        = {}     # For each column, the sort key of each row (in the current order), computed when needed
 
         # Default configuration for this list
         self.set_rules_hint(True)
@@ -149,24 +166,27 @@ class ExtListView(gtk.TreeView):
                     self.sortColCriteria[column] = sortIndexes
 
                 for (renderer, type) in renderers:
+                    column.pack_start(renderer, False)
+
+                    # The content of this renderer is provided by a cell data function
+                    if type is None:
+                        continue
+
                     nbEntries += 1
                     dataTypes.append(type)
-                    column.pack_start(renderer, False)
                     if   isinstance(renderer, gtk.CellRendererToggle): column.add_attribute(renderer, 'active', nbEntries-1)
                     elif isinstance(renderer, gtk.CellRendererPixbuf): column.add_attribute(renderer, 'pixbuf', nbEntries-1)
                     elif isinstance(renderer, gtk.CellRendererText):
                         if useMarkup: column.add_attribute(renderer, 'markup', nbEntries-1)
                         else:         column.add_attribute(renderer, 'text',   nbEntries-1)
 
-        # Mark management
-        self.markedRow  = None
-        self.markColumn = len(dataTypes)
-        dataTypes.append(TYPE_BOOLEAN)     # When there's no other solution, this additional entry helps in finding the marked row
-
         # Create the ListStore associated with this tree
         self.store = gtk.ListStore(*dataTypes)
         self.set_model(self.store)
 
+        # Mark management: the reference follows the marked row whenever rows are inserted, removed, or reordered
+        self.markedRow = None
+
         # Drag'n'drop management
         self.dndContext    = None
         self.dndTargets    = dndTargets
@@ -201,6 +221,44 @@ class ExtListView(gtk.TreeView):
             column.queue_resize()
 
 
+    def __detachModel(self, nbRows):
+        """
+            Detach the model from the view if nbRows rows are about to be modified
+            Return the state of the view (selected rows, cursor, first visible row) to be given to __attachModel(), or None if the model has not been detached
+        """
+        if nbRows <= BULK_MIN_ROWS or self.get_model() is None:
+            return None
+
+        cursor  = self.get_cursor()[0]
+        visible = self.get_visible_range()
+
+        if cursor is not None:  cursor = cursor[0]
+        if visible is not None: visible = visible[0][0]
+
+        state = ([path[0] for path in self.selection.get_selected_rows()[1]], cursor, visible)
+        self.set_model(None)
+
+        return state
+
+
+    def __attachModel(self, state, newIndex):
+        """ Attach the model again to the view and restore its state, newIndex(index) gives the new index of a row, None if it has been removed """
+        (selected, cursor, visible) = state
+
+        self.set_model(self.store)
+
+        if cursor is not None and newIndex(cursor) is not None:
+            self.set_cursor(newIndex(cursor))
+
+        self.selection.unselect_all()
+        for index in selected:
+            if newIndex(index) is not None:
+                self.selection.select_path(newIndex(index))
+
+        if visible is not None and newIndex(visible) is not None:
+            self.scroll_to_cell(newIndex(visible), None, True, 0, 0)
+
+
     def addColumnAttribute(self, colIndex, renderer, attribute, value):
         """ Add a new attribute to the given column """
         self.get_column(colIndex).add_attribute(renderer, attribute, value)
@@ -211,47 +269,33 @@ class ExtListView(gtk.TreeView):
 
     def hasMark(self):
         """ True if a mark has been set """
-        return self.markedRow is not None
+        return self.markedRow is not None and self.markedRow.valid()
 
 
     def hasMarkAbove(self, index):
         """ True if a mark is set and is above the given index """
-        return self.markedRow is not None and self.markedRow > index
+        return self.hasMark() and self.getMark() > index
 
 
     def hasMarkUnder(self, index):
         """ True if a mark is set and is undex the given index """
-        return self.markedRow is not None and self.markedRow < index
+        return self.hasMark() and self.getMark() < index
 
 
     def clearMark(self):
         """ Remove the mark """
-        if self.markedRow is not None:
-            self.setItem(self.markedRow, self.markColumn, False)
-            self.markedRow = None
+        self.markedRow = None
 
 
     def getMark(self):
         """ Return the index of the marked row """
-        return self.markedRow
+        if self.hasMark(): return self.markedRow.get_path()[0]
+        else:              return None
 
 
     def setMark(self, rowIndex):
         """ Put the mark on the given row, it will move with the row itself (e.g., D'n'D) """
-        self.clearMark()
-        self.markedRow = rowIndex
-        self.setItem(rowIndex, self.markColumn, True)
-
-
-    def __findMark(self):
-        """ Linear search for the marked row -- To be used only when there's no other solution """
-        iter = self.store.get_iter_first()
-
-        while iter is not None:
-            if self.store.get_value(iter, self.markColumn) == True:
-                self.markedRow = self.store.get_path(iter)[0]
-                break
-            iter = self.store.iter_next(iter)
+        self.markedRow = gtk.TreeRowReference(self.store, (rowIndex,))
 
 
     # --== Sorting content ==--
@@ -264,24 +308,29 @@ class ExtListView(gtk.TreeView):
             self.sortLastCol = None
 
 
-    def __cmpRows(self, row1, row2, criteria, ascending):
-        """ Compare two rows based on the given criteria, the latter being a tuple of the indexes to use for the comparison """
-        # Sorting on the first criterion may be done either ascending or descending
-        criterion = criteria[0]
-        result    = cmp(row1[criterion], row2[criterion])
+    def __getSortValue(self, row, criterion):
+        """ Return the value of the given row for the given criterion, the latter being either an index or a function """
+        if callable(criterion): return criterion(row)
+        else:                   return row[criterion]
 
-        if result != 0:
-            if ascending: return result
-            else:         return -result
 
-        # For subsequent criteria, the order is always ascending
-        for criterion in criteria[1:]:
-            result = cmp(row1[criterion], row2[criterion])
+    def __getSortKeys(self, column):
+        """ Return the sort keys of the given column, i.e., a tuple of values per row based on the criteria of the column """
+        if column not in self.sortKeys:
+            criteria = self.sortColCriteria[column]
+            self.sortKeys[column] = [tuple([self.__getSortValue(row, criterion) for criterion in criteria]) for row in self.iterAllRows()]
 
-            if result != 0:
-                return result
+        return self.sortKeys[column]
 
-        return 0
+
+    def __invalidateSortKeys(self, colIndex=None):
+        """ Forget the sort keys that depend on the given data index, or all of them if colIndex is None """
+        if colIndex is None:
+            self.sortKeys.clear()
+        else:
+            for column in self.sortKeys.keys():
+                if colIndex in self.sortColCriteria[column]:
+                    del self.sortKeys[column]
 
 
     def __sortRows(self, column):
@@ -292,22 +341,29 @@ class ExtListView(gtk.TreeView):
         if self.sortLastCol is not None:
             self.sortLastCol.set_sort_indicator(False)
 
-        # Find how sorting must be done
+        keys = self.__getSortKeys(column)
+
+        # Subsequent criteria are always sorted in ascending order, so when the rows are already sorted on this column, only the
+        # order of the groups of rows sharing the same value for the first criterion has to be reversed
         if self.sortLastCol == column:
             self.sortAscending = not self.sortAscending
+
+            order = []
+            end   = len(keys)
+            for start in xrange(len(keys)-1, -1, -1):
+                if start == 0 or keys[start-1][0] != keys[start][0]:
+                    order.extend(xrange(start, end))
+                    end = start
         else:
             self.sortLastCol   = column
             self.sortAscending = True
+            order              = sorted(xrange(len(keys)), key=keys.__getitem__)
 
-        # Dump the rows, sort them, and reorder the list
-        rows     = [tuple(r) + (i,) for i, r in enumerate(self.store)]
-        criteria = self.sortColCriteria[column]
-        rows.sort(lambda r1, r2: self.__cmpRows(r1, r2, criteria, self.sortAscending))
-        self.store.reorder([r[-1] for r in rows])
+        self.store.reorder(order)
 
-        # Move the mark if needed
-        if self.markedRow is not None:
-            self.__findMark()
+        # Cached keys must follow the rows
+        for sortedColumn, sortedKeys in self.sortKeys.items():
+            self.sortKeys[sortedColumn] = [sortedKeys[i] for i in order]
 
         column.set_sort_indicator(True)
         if self.sortAscending: column.set_sort_order(gtk.SORT_ASCENDING)
@@ -336,12 +392,12 @@ class ExtListView(gtk.TreeView):
 
     def getSelectedRows(self):
         """ Return all selected row(s) """
-        return [tuple(self.store[path])[:-1] for path in self.selection.get_selected_rows()[1]]
+        return [tuple(self.store[path]) for path in self.selection.get_selected_rows()[1]]
 
 
     def getFirstSelectedRow(self):
         """ Return only the first selected row """
-        return tuple(self.store[self.selection.get_selected_rows()[1][0]])[:-1]
+        return tuple(self.store[self.selection.get_selected_rows()[1][0]])
 
 
     def getFirstSelectedRowIndex(self):
@@ -352,7 +408,7 @@ class ExtListView(gtk.TreeView):
     def iterSelectedRows(self):
         """ Iterate on all selected row(s) """
         for path in self.selection.get_selected_rows()[1]:
-            yield tuple(self.store[path])[:-1]
+            yield tuple(self.store[path])
 
 
     # --== Retrieving content / Iterating on content ==--
@@ -370,18 +426,18 @@ class ExtListView(gtk.TreeView):
 
     def getRow(self, rowIndex):
         """ Return the given row """
-        return tuple(self.store[rowIndex])[:-1]
+        return tuple(self.store[rowIndex])
 
 
     def getAllRows(self):
         """ Return all rows """
-        return [tuple(row)[:-1] for row in self.store]
+        return [tuple(row) for row in self.store]
 
 
     def iterAllRows(self):
         """ Iterate on all rows """
         for row in self.store:
-            yield tuple(row)[:-1]
+            yield tuple(row)
 
 
     def getItem(self, rowIndex, colIndex):
@@ -395,6 +451,7 @@ class ExtListView(gtk.TreeView):
     def clear(self):
         """ Remove all rows from the list """
         self.__resetSorting()
+        self.__invalidateSortKeys()
         self.clearMark()
         self.store.clear()
         self.__resizeColumns()
@@ -406,39 +463,63 @@ class ExtListView(gtk.TreeView):
         # Check if changing that item may change the sorting: if so, reset sorting
         if self.sortLastCol is not None and colIndex in self.sortColCriteria[self.sortLastCol]:
             self.__resetSorting()
+        self.__invalidateSortKeys(colIndex)
         self.store.set_value(self.store.get_iter(rowIndex), colIndex, value)
 
 
-    def removeSelectedRows(self):
-        """ Remove the selected row(s) """
+    def __removeRows(self, indexes):
+        """ Remove the rows with the given indexes, which must be sorted in ascending order """
+        if len(indexes) == 0:
+            return
+
+        mark    = self.getMark()
+        removed = set(indexes)
+
+        # Removing rows does not change the order of the remaining ones, so their sort keys are still valid
+        for column, keys in self.sortKeys.items():
+            self.sortKeys[column] = [key for i, key in enumerate(keys) if i not in removed]
+
         self.freeze_child_notify()
-        for iter in self.__getIterOnSelectedRows():
-            # Move the mark if needed
-            if self.markedRow is not None:
-                currentPath = self.store.get_path(iter)[0]
-                if   currentPath < self.markedRow:  self.markedRow -= 1
-                elif currentPath == self.markedRow: self.markedRow  = None
-            # Remove the current row
-            if   self.store.remove(iter): self.set_cursor(self.store.get_path(iter))
-            elif len(self.store) != 0:    self.set_cursor(len(self.store)-1)
+        viewState = self.__detachModel(len(indexes))
+
+        # Either remove the given rows or rebuild the list with the remaining ones, whichever is the cheapest
+        if len(indexes) > len(self.store) - len(indexes):
+            rows = [tuple(row) for i, row in enumerate(self.store) if i not in removed]
+            self.store.clear()
+            for row in rows:
+                self.store.append(row)
+
+            if mark is not None and mark not in removed:
+                self.setMark(mark - bisect.bisect_left(indexes, mark))
+        else:
+            for index in reversed(indexes):
+                self.store.remove(self.store.get_iter(index))
+
+        if viewState is not None:
+            self.__attachModel(viewState, lambda index: None if index in removed else index - bisect.bisect_left(indexes, index))
         self.thaw_child_notify()
-        if len(self.store) == 0:
+
+        # Put the cursor on the row following the first removed one
+        if len(self.store) != 0:
+            self.set_cursor(min(indexes[0], len(self.store)-1))
+        else:
             self.set_cursor(0)
             self.__resetSorting()
+
         self.__resizeColumns()
         self.emit('extlistview-modified')
 
 
+    def removeSelectedRows(self):
+        """ Remove the selected row(s) """
+        self.__removeRows([path[0] for path in self.selection.get_selected_rows()[1]])
+
+
     def cropSelectedRows(self):
         """ Remove all rows but the selected ones """
-        pathsList = self.selection.get_selected_rows()[1]
-        self.freeze_child_notify()
-        self.selection.select_all()
-        for path in pathsList:
-            self.selection.unselect_path(path)
-        self.removeSelectedRows()
+        selected = set([path[0] for path in self.selection.get_selected_rows()[1]])
+        self.__removeRows([i for i in xrange(len(self.store)) if i not in selected])
         self.selection.select_all()
-        self.thaw_child_notify()
 
 
     def insertRows(self, rows, position=None):
@@ -446,23 +527,27 @@ class ExtListView(gtk.TreeView):
         if len(rows) == 0:
             return
 
-        # Insert the additional column used for the mark management
-        if type(rows[0]) is tuple: rows[:] = [row + (False,) for row in rows]
-        else:                      rows[:] = [row + [False] for row in rows]
-
-        # Move the mark if needed
-        if self.markedRow is not None and position is not None and position <= self.markedRow:
-            self.markedRow += len(rows)
-
         # Insert rows
+        self.__invalidateSortKeys()
         self.freeze_child_notify()
-        if position is None:
+        viewState = self.__detachModel(len(rows))
+        nbRows    = len(self.store)
+
+        if position is None or position >= nbRows:
             for row in rows:
                 self.store.append(row)
+        elif len(rows) <= BULK_MIN_ROWS:
+            for i, row in enumerate(rows):
+                self.store.insert(position + i, row)
         else:
+            # Many rows are appended and moved to their position at once, rather than inserted one by one
             for row in rows:
-                self.store.insert(position, row)
-                position += 1
+                self.store.append(row)
+            self.store.reorder(range(position) + range(nbRows, nbRows + len(rows)) + range(position, nbRows))
+
+        if viewState is not None:
+            if position is None: self.__attachModel(viewState, lambda index: index)
+            else:                self.__attachModel(viewState, lambda index: index + len(rows) * (index >= position))
         self.thaw_child_notify()
         self.__resetSorting()
         self.emit('extlistview-modified')
@@ -487,13 +572,14 @@ class ExtListView(gtk.TreeView):
         """ Shuffle the content of the list """
         order = range(len(self.store))
         random.shuffle(order)
-        self.store.reorder(order)
+        self.reorder(order)
 
-        # Move the mark if needed
-        if self.markedRow is not None:
-            self.__findMark()
 
+    def reorder(self, order):
+        """ Reorder the rows, order[i] being the current index of the row that must be moved to index i """
+        self.store.reorder(order)
         self.__resetSorting()
+        self.__invalidateSortKeys()
         self.emit('extlistview-modified')
 
 
@@ -525,9 +611,11 @@ class ExtListView(gtk.TreeView):
                 pos   = gtk.TREE_VIEW_DROP_INTO_OR_BEFORE
                 path += 1
 
+        self.__invalidateSortKeys()
         self.freeze_child_notify()
         for srcIter in iterList:
             srcPath = self.store.get_path(srcIter)[0]
+            marked  = (srcPath == self.getMark())
 
             if self.__isDropAfter(pos):
                 dstIter = self.store.insert_after(self.store.get_iter(path),  self.store[srcIter])
@@ -536,16 +624,15 @@ class ExtListView(gtk.TreeView):
                 if path == srcPath:
                     path += 1
 
+            # The row is copied, so the mark must be moved to the copy before removing the original row
+            if marked:
+                self.setMark(self.store.get_path(dstIter)[0])
+
             self.store.remove(srcIter)
             dstPath = self.store.get_path(dstIter)[0]
 
             if srcPath > dstPath:
                 path += 1
-
-            if self.markedRow is not None:
-                if   srcPath == self.markedRow:                              self.markedRow  = dstPath
-                elif srcPath < self.markedRow and dstPath >= self.markedRow: self.markedRow -= 1
-                elif srcPath > self.markedRow and dstPath <= self.markedRow: self.markedRow += 1
         self.thaw_child_notify()
         self.__resetSorting()
         self.emit('extlistview-modified')
@@ -16,7 +16,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import os, playlist, tools, traceback
+import multiprocessing, os, playlist, Queue, sys, tagCache, threading, tools, traceback
 
 from format          import monkeysaudio, asf, flac, mp3, mp4, mpc, ogg, wavpack
 from os.path         import splitext
@@ -27,6 +27,16 @@ from track.fileTrack import FileTrack
 # Supported formats with associated modules
 mFormats = {'.ac3': monkeysaudio, '.ape': monkeysaudio, '.flac': flac, '.m4a': mp4, '.mp2': mp3, '.mp3': mp3, '.mp4': mp4, '.mpc': mpc,'.oga': ogg, '.ogg': ogg, '.wma': asf, '.wv': wavpack}
 
+# Tags extraction is mostly spent waiting for the disk, so several files are parsed at the same time by a pool of threads
+MIN_FILES_PER_WORKER = 16   # Don't start a thread for less than this number of files
+
+try:    DEFAULT_NB_WORKERS = max(2, multiprocessing.cpu_count())
+except: DEFAULT_NB_WORKERS = 2
+
+# iterTracks() starts with small batches so that the first tracks are quickly available, and then doubles their size up to a maximum
+STREAM_MIN_BATCH_SIZE = 8
+STREAM_MAX_BATCH_SIZE = 256
+
 
 def isSupported(file):
     """ Return True if the given file is a supported format """
@@ -43,46 +53,131 @@ def getTrackFromFile(file):
     """
         Return a Track object, based on the tags of the given file
         The 'file' parameter must be a real file (not a playlist or a directory)
+        Tags are taken from the tag cache when the file has not been modified since it was last parsed
     """
     try:
-        return mFormats[splitext(file.lower())[1]].getTrack(file)
+        fileStat = os.stat(file)
+        tags     = tagCache.get(file, fileStat)
+
+        if tags is not None:
+            track = FileTrack(file)
+            track.setTags(tags)
+            return track
+
+        track = mFormats[splitext(file.lower())[1]].getTrack(file)
+        tagCache.set(file, fileStat, track.getTags())
+        return track
     except:
         logger.error('Unable to extract information from %s\n\n%s' % (file, traceback.format_exc()))
         return FileTrack(file)
 
 
-def getTracksFromFiles(files):
-    """ Same as getTrackFromFile(), but works on a list of files instead of a single one """
-    return [getTrackFromFile(file) for file in files]
+def __extractionWorker(files, tracks, jobs):
+    """ Extract the tags of the files whose indexes are taken from the queue, store the resulting tracks at the same indexes """
+    while True:
+        try:                index = jobs.get_nowait()
+        except Queue.Empty: return
+
+        tracks[index] = getTrackFromFile(files[index])
+
+
+def getTracksFromFiles(files, nbWorkers=None):
+    """
+        Same as getTrackFromFile(), but works on a list of files instead of a single one
+        Tags are extracted by a pool of nbWorkers threads (DEFAULT_NB_WORKERS if None), the order of the files is preserved
+    """
+    if nbWorkers is None:
+        nbWorkers = DEFAULT_NB_WORKERS
+
+    nbWorkers = min(nbWorkers, len(files) / MIN_FILES_PER_WORKER)
+
+    # Not worth the overhead of starting threads
+    if nbWorkers <= 1:
+        return [getTrackFromFile(file) for file in files]
+
+    jobs   = Queue.Queue(0)
+    tracks = [None] * len(files)
+
+    for index in xrange(len(files)):
+        jobs.put(index)
+
+    workers = [threading.Thread(target=__extractionWorker, args=(files, tracks, jobs)) for i in xrange(nbWorkers)]
 
+    for worker in workers:
+        worker.start()
 
-def getTracks(filenames, sortByFilename=False):
-    """ Same as getTracksFromFiles(), but works for any kind of filenames (files, playlists, directories) """
+    for worker in workers:
+        worker.join()
+
+    return tracks
+
+
+def __sortTracks(tracks, sortByFilename):
+    """ Return a sorted copy of the given list of tracks, sorted either by filename or by tags """
+    if sortByFilename: return sorted(tracks, lambda t1, t2: cmp(t1.getFilePath(), t2.getFilePath()))
+    else:              return sorted(tracks)
+
+
+def iterTracks(filenames, sortByFilename=False, nbWorkers=None, batchSize=STREAM_MIN_BATCH_SIZE):
+    """
+        Same as getTracks(), but the tracks are yielded by batches while directories are walked and files are parsed
+        Each item is a tuple (tracks, allTracks):
+            * For all items but the last one, tracks is the next batch of tracks (not sorted) and allTracks is None
+            * For the last item, tracks is empty and allTracks is the complete list of tracks, ordered as getTracks() would have done
+    """
     allTracks = []
 
     # Directories
     for directory in [filename for filename in filenames if os.path.isdir(filename)]:
-        mediaFiles, playlists = [], []
+        dirTracks, mediaFiles, playlists = [], [], []
+
         for root, subdirs, files in os.walk(directory):
             for file in files:
                 if isSupported(file):            mediaFiles.append(os.path.join(root, file))
                 elif playlist.isSupported(file): playlists.append(os.path.join(root, file))
 
+            while len(mediaFiles) >= batchSize:
+                tracks = getTracksFromFiles(mediaFiles[:batchSize], nbWorkers)
+                del mediaFiles[:batchSize]
+                dirTracks.extend(tracks)
+                batchSize = max(batchSize, min(batchSize * 2, STREAM_MAX_BATCH_SIZE))
+                yield (tracks, None)
+
+        if len(mediaFiles) != 0:
+            tracks = getTracksFromFiles(mediaFiles, nbWorkers)
+            dirTracks.extend(tracks)
+            yield (tracks, None)
 
-        if sortByFilename: allTracks.extend(sorted(getTracksFromFiles(mediaFiles), lambda t1, t2: cmp(t1.getFilePath(), t2.getFilePath())))
-        else:              allTracks.extend(sorted(getTracksFromFiles(mediaFiles)))
+        allTracks.extend(__sortTracks(dirTracks, sortByFilename))
 
         for pl in playlists:
-            allTracks.extend(getTracksFromFiles(playlist.load(pl)))
+            tracks = getTracksFromFiles(playlist.load(pl), nbWorkers)
+            allTracks.extend(tracks)
+            yield (tracks, None)
 
     # Files
-    tracks = getTracksFromFiles([filename for filename in filenames if os.path.isfile(filename) and isSupported(filename)])
+    tracks = getTracksFromFiles([filename for filename in filenames if os.path.isfile(filename) and isSupported(filename)], nbWorkers)
 
-    if sortByFilename: allTracks.extend(sorted(tracks, lambda t1, t2: cmp(t1.getFilePath(), t2.getFilePath())))
-    else:              allTracks.extend(sorted(tracks))
+    if len(tracks) != 0:
+        allTracks.extend(__sortTracks(tracks, sortByFilename))
+        yield (tracks, None)
 
     # Playlists
     for pl in [filename for filename in filenames if os.path.isfile(filename) and playlist.isSupported(filename)]:
-        allTracks.extend(getTracksFromFiles(playlist.load(pl)))
+        tracks = getTracksFromFiles(playlist.load(pl), nbWorkers)
+        allTracks.extend(tracks)
+        yield (tracks, None)
+
+    yield ([], allTracks)
+
+
+def getTracks(filenames, sortByFilename=False, nbWorkers=None):
+    """
+        Same as getTracksFromFiles(), but works for any kind of filenames (files, playlists, directories)
+        See getTracksFromFiles() for the meaning of nbWorkers
+    """
+    # Using a huge batch size, each directory is entirely walked before its files are parsed
+    for tracks, allTracks in iterTracks(filenames, sortByFilename, nbWorkers, sys.maxint):
+        pass
 
     return allTracks
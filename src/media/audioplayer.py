@@ -16,67 +16,384 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import pygst
+import gobject, pygst
 pygst.require('0.10')
 import gst
 
 
+PREROLL_DEFAULT   = 4   # By default, the next track is requested this number of seconds before the end of the current one
+CROSSFADE_DEFAULT = 0   # By default, tracks are not crossfaded
+
+# States of the player, which are changed immediately while the pipeline changes its own state asynchronously
+(
+    PLAYER_STOPPED,
+    PLAYER_STARTING,   # The pipeline is going to play a new URI, URIs requested in the meantime are coalesced
+    PLAYER_PLAYING,
+    PLAYER_PAUSED
+) = range(4)
+
+# Audio effects that may be inserted in the audio bin, in the order they are linked: (name of the element, name of the factory)
+EFFECTS = (
+    ('replaygain', 'rgvolume'),
+    ('equalizer',  'equalizer-10bands'),
+)
+
+
 class AudioPlayer:
 
-    def __init__(self, callbackEnded, usePlaybin2=False):
-        """ Constructor """
-        if usePlaybin2:
-            self.player = gst.element_factory_make('playbin2', 'player')
-            self.player.connect('about-to-finish', self.__onAboutToFinish)
+    def __init__(self, callbackEnded, usePlaybin2=False, callbackNeedNext=None, preroll=PREROLL_DEFAULT, crossfade=CROSSFADE_DEFAULT):
+        """
+            Constructor
+            callbackNeedNext is called (without parameter) when the next URI should be given to setNextURI(), preroll seconds before the end of the track
+            With playbin, the next URI is then pre-rolled in a second pipeline, which replaces the current one at the end of the track
+            If crossfade is not 0, the second pipeline starts playing crossfade seconds before the end of the track, while the current one fades out
+        """
+        self.state            = PLAYER_STOPPED
+        self.volume           = 1.0
+        self.preroll          = preroll
+        self.effects          = set()  # Names of the enabled audio effects
+        self.eqzLvls          = None
+        self.nextURI          = None
+        self.pendingURI       = None   # URI to be played once the pipeline is done with starting the current one
+        self.chainedURI       = None   # URI automatically played at the end of the previous track
+        self.nextPlayer       = None   # Pipeline pre-rolled with the next URI
+        self.fadingPlayer     = None   # Pipeline fading out while the next one fades in
+        self.faders           = {}     # Volume controllers of the pipelines, only used for crossfading
+        self.usePlaybin2      = usePlaybin2
+        self.needNextTimer    = None
+        self.crossfadeTimer   = None
+        self.callbackEnded    = callbackEnded
+        self.callbackNeedNext = callbackNeedNext
+
+        # Crossfading requires a second pipeline, which is not used with playbin2
+        if usePlaybin2: self.crossfade = 0
+        else:           self.crossfade = crossfade
+
+        self.player = self.__createPipeline()
+
+
+    def __createPipeline(self):
+        """ Create a new pipeline, with the current volume and audio effects """
+        if self.usePlaybin2:
+            player = gst.element_factory_make('playbin2')
+            player.connect('about-to-finish', self.__onAboutToFinish)
         else:
-            self.player = gst.element_factory_make('playbin', 'player')
-
-        self.nextURI       = None
-        self.equalizer     = None
-        self.replaygain    = None
-        self.callbackEnded = callbackEnded
+            player = gst.element_factory_make('playbin')
 
         # No video
-        self.player.set_property('video-sink', gst.element_factory_make('fakesink', 'fakesink'))
+        player.set_property('video-sink', gst.element_factory_make('fakesink', 'fakesink'))
+        player.set_property('volume', self.volume)
+
+        # Change the audio sink to our own bin, so that audio effects can be inserted between its head and the sink
+        # The head is always there, so that the data flow can be blocked on its source pad while the effects are relinked
+        audiobin  = gst.Bin('audiobin')
+        audiohead = gst.element_factory_make('audioconvert',  'audiohead')
+        audiosink = gst.element_factory_make('autoaudiosink', 'audiosink')
+
+        audiobin.add(audiohead, audiosink)
+        audiobin.add_pad(gst.GhostPad('sink', audiohead.get_pad('sink')))
+        player.set_property('audio-sink', audiobin)
 
-        # Change the audio sink to our own bin, so that an equalizer/replay gain element can be added later on if needed
-        self.audiobin  = gst.Bin('audiobin')
-        self.audiosink = gst.element_factory_make('autoaudiosink', 'audiosink')
+        # The fader is linked just before the sink, its volume is driven by a controller during crossfades
+        if self.crossfade != 0:
+            fader = gst.element_factory_make('volume', 'fader')
+            audiobin.add(fader)
 
-        self.audiobin.add(self.audiosink)
-        self.audiobin.add_pad(gst.GhostPad('sink', self.audiosink.get_pad('sink')))
-        self.player.set_property('audio-sink', self.audiobin)
+            self.faders[player] = gst.Controller(fader, 'volume')
+            self.faders[player].set_interpolation_mode('volume', gst.INTERPOLATE_LINEAR)
+
+        self.__linkEffects(player)
 
         # Monitor messages generated by the player
-        bus = self.player.get_bus()
+        bus = player.get_bus()
         bus.add_signal_watch()
-        bus.connect('message', self.__onGstMessage)
+        bus.connect('message', self.__onGstMessage, player)
+
+        return player
+
+
+    def __destroyPipeline(self, player):
+        """ Release the resources used by the given pipeline """
+        player.set_state(gst.STATE_NULL)
+        player.get_bus().remove_signal_watch()
+
+        if player in self.faders:
+            del self.faders[player]
+
+
+    def __getElement(self, player, name):
+        """ Return the element of the audio bin of the given pipeline with the given name, or None if there is none """
+        return player.get_property('audio-sink').get_by_name(name)
+
+
+    # --== Pre-rolling ==--
+
+
+    def __prepareNextPipeline(self):
+        """ Pre-roll the next URI in a second pipeline, so that playback can start as soon as the current track ends """
+        self.__dropNextPipeline()
+
+        if not self.usePlaybin2 and self.nextURI is not None:
+            self.nextPlayer = self.__createPipeline()
+            self.nextPlayer.set_property('uri', self.nextURI)
+
+            # The fade-in must be programmed before the first buffer goes through the fader
+            if self.crossfade != 0:
+                self.__setFade(self.nextPlayer, 0, 0.0, 1.0)
+
+            self.nextPlayer.set_state(gst.STATE_PAUSED)
+
+
+    def __dropNextPipeline(self):
+        """ Destroy the pre-rolled pipeline, if any """
+        self.__cancelCrossfade()
+
+        if self.nextPlayer is not None:
+            self.__destroyPipeline(self.nextPlayer)
+            self.nextPlayer = None
+
+
+    def __switchToNextURI(self):
+        """ Start playing the next URI, pre-rolled if possible """
+        self.__cancelCrossfade()
+        self.__dropFadingPipeline()
+
+        if self.nextPlayer is not None:
+            # No crossfade at this point, the fade-in programmed when pre-rolling must be cancelled
+            if self.crossfade != 0:
+                self.__resetFade(self.nextPlayer)
+
+            self.__destroyPipeline(self.player)
+            self.state      = PLAYER_PLAYING
+            self.player     = self.nextPlayer
+            self.nextURI    = None
+            self.nextPlayer = None
+            self.player.set_state(gst.STATE_PLAYING)
+        else:
+            self.pendingURI = self.nextURI
+            self.nextURI    = None
+            self.__startPendingURI()
+
+
+    def __startPendingURI(self):
+        """ Ask the pipeline to play the pending URI, the state of the player is updated when the pipeline is actually playing """
+        self.__cancelNeedNext()
+        self.__dropFadingPipeline()
+
+        self.state = PLAYER_STARTING
+        self.player.set_state(gst.STATE_READY)
+        self.player.set_property('uri', self.pendingURI)
+
+        # The pipeline may be the one that faded in, its fader must be reset for the new URI
+        if self.crossfade != 0:
+            self.__resetFade(self.player)
+
+        self.player.set_state(gst.STATE_PLAYING)
+
+        self.pendingURI = None
+
+
+    def __scheduleNeedNext(self, afterCurrentStream=False):
+        """
+            Schedule the request for the next URI, based on the current position in the stream
+            If afterCurrentStream is True, a new stream is going to follow the current one, and the request is scheduled once it has started
+        """
+        self.__cancelNeedNext()
+
+        if self.callbackNeedNext is None or self.nextURI is not None:
+            return False
+
+        try:
+            remaining = self.getDuration() - self.getPosition()
+
+            if afterCurrentStream: delay = remaining / 1000000 + 1000
+            else:                  delay = max(0, remaining - self.__getLookahead()) / 1000000
+        except gst.QueryError:
+            # Duration may not be known yet, try again later
+            delay = 1000
+
+        self.needNextTimer = gobject.timeout_add(int(delay), self.__onNeedNextTimer)
+
+        return False
+
+
+    def __cancelNeedNext(self):
+        """ Cancel the request for the next URI, if any """
+        if self.needNextTimer is not None:
+            gobject.source_remove(self.needNextTimer)
+            self.needNextTimer = None
+
+
+    def __onNeedNextTimer(self):
+        """ Time to request the next URI """
+        self.needNextTimer = None
+
+        if self.nextURI is None:
+            try:
+                remaining = self.getDuration() - self.getPosition()
+            except gst.QueryError:
+                remaining = None
+
+            if remaining is None or remaining > self.__getLookahead(): self.__scheduleNeedNext()
+            else:                                                       self.callbackNeedNext()
+
+        return False
+
+
+    def __getLookahead(self):
+        """ Return how long (ns) before the end of the track the next URI must be requested, so that it is pre-rolled before the crossfade starts """
+        return (self.preroll + self.crossfade) * 1000000000
+
+
+    # --== Crossfading ==--
+
+
+    def __setFade(self, player, start, fromLevel, toLevel):
+        """ Program the fader of the given pipeline to go from fromLevel to toLevel, starting at the given stream time (ns) """
+        controller = self.faders[player]
+        controller.unset_all('volume')
+        controller.set('volume', start, fromLevel)
+        controller.set('volume', start + int(self.crossfade * 1000000000), toLevel)
+
+
+    def __resetFade(self, player):
+        """ Remove the program of the fader of the given pipeline, and restore its full volume """
+        self.faders[player].unset_all('volume')
+        self.__getElement(player, 'fader').set_property('volume', 1.0)
+
+
+    def __scheduleCrossfade(self):
+        """ Schedule the crossfade with the pre-rolled pipeline, based on the current position in the stream """
+        self.__cancelCrossfade()
+
+        if self.crossfade == 0 or self.nextPlayer is None:
+            return
+
+        try:
+            remaining = self.getDuration() - self.getPosition()
+        except gst.QueryError:
+            # Without a duration, the next track simply starts at the end of the current one
+            return
+
+        delay = max(0, remaining - self.crossfade * 1000000000) / 1000000
+        self.crossfadeTimer = gobject.timeout_add(int(delay), self.__onCrossfadeTimer)
+
+
+    def __cancelCrossfade(self):
+        """ Cancel the scheduled crossfade, if any """
+        if self.crossfadeTimer is not None:
+            gobject.source_remove(self.crossfadeTimer)
+            self.crossfadeTimer = None
+
+
+    def __onCrossfadeTimer(self):
+        """ Time to start the next pipeline, while the current one fades out until its end """
+        self.crossfadeTimer = None
+
+        if self.nextPlayer is not None and self.state == PLAYER_PLAYING:
+            try:
+                self.__setFade(self.player, self.getPosition(), 1.0, 0.0)
+            except gst.QueryError:
+                return False
+
+            # Playback goes on with the next URI as if the previous track had ended
+            self.fadingPlayer = self.player
+            self.chainedURI   = self.nextURI
+            self.player       = self.nextPlayer
+            self.nextURI      = None
+            self.nextPlayer   = None
+            self.player.set_state(gst.STATE_PLAYING)
+            self.callbackEnded(False)
+
+        return False
+
+
+    def __dropFadingPipeline(self):
+        """ Destroy the pipeline that is fading out, if any """
+        if self.fadingPlayer is not None:
+            self.__destroyPipeline(self.fadingPlayer)
+            self.fadingPlayer = None
+
+
+    # --== GStreamer callbacks ==--
 
 
     def __onAboutToFinish(self, isLast):
         """ Feed the next URI if we have one """
         if self.nextURI is not None:
             self.player.set_property('uri', self.nextURI)
-            self.nextURI = None
+            self.chainedURI = self.nextURI
+            self.nextURI    = None
+            self.callbackEnded(False)
+            # The position is still the one in the current stream, so the next request must wait for the new stream to start
+            gobject.idle_add(self.__scheduleNeedNext, True)
+
+
+    def __onGstMessage(self, bus, msg, player):
+        """ A new message generated by one of the pipelines """
+        if player is not self.player:
+            # The next URI cannot be pre-rolled, it will be played by the current pipeline to report the error
+            if player is self.nextPlayer and msg.type == gst.MESSAGE_ERROR:
+                self.__dropNextPipeline()
+            # The previous track has faded out
+            elif player is self.fadingPlayer and (msg.type == gst.MESSAGE_EOS or msg.type == gst.MESSAGE_ERROR):
+                self.__dropFadingPipeline()
+        elif msg.type == gst.MESSAGE_EOS:
+            if self.nextURI is None:
+                self.state = PLAYER_STOPPED
+            else:
+                self.chainedURI = self.nextURI
+                self.__switchToNextURI()
             self.callbackEnded(False)
+        elif msg.type == gst.MESSAGE_ERROR:
+            # There is no need to report an error for a URI the user has already skipped
+            if self.state == PLAYER_STARTING and self.pendingURI is not None:
+                self.__startPendingURI()
+            else:
+                self.state = PLAYER_STOPPED
+                self.__cancelNeedNext()
+                self.callbackEnded(True)
+        elif msg.type == gst.MESSAGE_ASYNC_DONE:
+            # Pre-rolling or seeking is done, the position in the stream may have changed
+            if player.get_state(0)[1] == gst.STATE_PLAYING:
+                self.__scheduleNeedNext()
+                self.__scheduleCrossfade()
+        elif msg.type == gst.MESSAGE_STATE_CHANGED and msg.src is player:
+            newState = msg.parse_state_changed()[1]
+
+            if newState != gst.STATE_PLAYING:
+                self.__cancelNeedNext()
+                self.__cancelCrossfade()
+            elif self.state == PLAYER_STARTING and self.pendingURI is not None:
+                # Only the last requested URI is played
+                self.__startPendingURI()
+            else:
+                if self.state == PLAYER_STARTING:
+                    self.state = PLAYER_PLAYING
+                self.__scheduleNeedNext()
+                self.__scheduleCrossfade()
 
+        return True
 
-    def __onGstMessage(self, bus, msg):
-        """ A new message generated by the player """
-        if   msg.type == gst.MESSAGE_EOS:   self.callbackEnded(False)
-        elif msg.type == gst.MESSAGE_ERROR: self.callbackEnded(True)
 
-        return True
+    # --== Next URI ==--
 
 
     def setNextURI(self, uri):
         """ Set the next URI """
         self.nextURI = uri.replace('#', '%23')
+        self.__cancelNeedNext()
+        self.__prepareNextPipeline()
+        self.__scheduleCrossfade()
 
 
     def clearNextURI(self):
         """ Clear the next URI """
         self.nextURI = None
+        self.__dropNextPipeline()
+
+
+    # --== Volume and audio effects ==--
 
 
     def setVolume(self, level):
@@ -84,109 +401,187 @@ class AudioPlayer:
         if level < 0:   level = 0
         elif level > 1: level = 1
 
-        self.player.set_property('volume', level)
+        self.volume = level
 
+        for player in (self.player, self.nextPlayer, self.fadingPlayer):
+            if player is not None:
+                player.set_property('volume', level)
 
-    def __saveRestoreState(self, func):
-        """  """
-        savedState = self.player.get_state()[1]
-        self.player.set_state(gst.STATE_NULL)
-        func()
-        self.player.set_state(savedState)
 
+    def __linkEffects(self, player):
+        """ Insert the enabled audio effects between the head and the sink of the audio bin of the given pipeline, and remove the others """
+        audiobin  = player.get_property('audio-sink')
+        audiohead = audiobin.get_by_name('audiohead')
+        audiosink = audiobin.get_by_name('audiosink')
 
-    def __enableEqualizer(self):
-        """ Add an equalizer to the audio chain """
-        self.equalizer = gst.element_factory_make('equalizer-10bands', 'equalizer')
-        self.audiobin.add(self.equalizer)
+        # Break the current chain, if any
+        element = audiohead
+        while element.get_name() != 'audiosink':
+            peer = element.get_pad('src').get_peer()
+            if peer is None:
+                break
 
-        if self.replaygain is None:
-            self.audiobin.get_pad('sink').set_target(self.equalizer.get_pad('sink'))
-        else:
-            self.replaygain.unlink(self.audiosink)
-            self.replaygain.link(self.equalizer)
+            nextElement = peer.get_parent_element()
+            element.unlink(nextElement)
+            element = nextElement
 
-        self.equalizer.link(self.audiosink)
+        # Build the new one
+        chain = [audiohead]
+        for (name, factory) in EFFECTS:
+            effect = audiobin.get_by_name(name)
 
+            if name not in self.effects:
+                if effect is not None:
+                    effect.set_state(gst.STATE_NULL)
+                    audiobin.remove(effect)
+                continue
 
-    def __enableReplayGain(self):
-        """ Add/Enable a replay gain element """
-        if self.replaygain is None:
-            self.replaygain = gst.element_factory_make('rgvolume', 'replaygain')
+            if effect is None:
+                effect = gst.element_factory_make(factory, name)
+                audiobin.add(effect)
+                effect.sync_state_with_parent()
 
-        self.audiobin.add(self.replaygain)
-        self.audiobin.get_pad('sink').set_target(self.replaygain.get_pad('sink'))
+                if name == 'equalizer' and self.eqzLvls is not None:
+                    self.__setEqualizerLvls(effect, self.eqzLvls)
 
-        if self.equalizer is None: self.replaygain.link(self.audiosink)
-        else:                      self.replaygain.link(self.equalizer)
+            chain.append(effect)
 
+        fader = audiobin.get_by_name('fader')
+        if fader is not None:
+            chain.append(fader)
 
-    def __disableReplayGain(self):
-        """ Disable the replay gain element, if any """
-        if self.replaygain is not None:
-            if self.equalizer is None: self.audiobin.get_pad('sink').set_target(self.audiosink.get_pad('sink'))
-            else:                      self.audiobin.get_pad('sink').set_target(self.equalizer.get_pad('sink'))
+        chain.append(audiosink)
+        gst.element_link_many(*chain)
 
-            self.audiobin.remove(self.replaygain)
+
+    def __onAudioHeadBlocked(self, pad, isBlocked, player):
+        """ The data flow is blocked (streaming thread), the audio effects can be safely relinked """
+        if isBlocked:
+            self.__linkEffects(player)
+            pad.set_blocked_async(False, self.__onAudioHeadBlocked, player)
+
+
+    def __updateEffects(self, player):
+        """ Update the audio effects of the given pipeline, without interrupting the playback """
+        # When data is flowing, the chain must not be modified until the head is blocked
+        if player.get_state(0)[1] == gst.STATE_PLAYING:
+            self.__getElement(player, 'audiohead').get_pad('src').set_blocked_async(True, self.__onAudioHeadBlocked, player)
+        else:
+            self.__linkEffects(player)
+
+
+    def __setEffect(self, name, enabled):
+        """ Enable or disable the given audio effect """
+        if enabled == (name in self.effects):
+            return
+
+        if enabled: self.effects.add(name)
+        else:       self.effects.remove(name)
+
+        for player in (self.player, self.nextPlayer):
+            if player is not None:
+                self.__updateEffects(player)
 
 
     def enableEqualizer(self):
         """ Add an equalizer to the audio chain """
-        self.__saveRestoreState(self.__enableEqualizer)
+        self.__setEffect('equalizer', True)
+
+
+    def disableEqualizer(self):
+        """ Remove the equalizer from the audio chain """
+        self.__setEffect('equalizer', False)
 
 
     def enableReplayGain(self):
-        """ Add/Enable a replay gain element """
-        self.__saveRestoreState(self.__enableReplayGain)
+        """ Add a replay gain element to the audio chain """
+        self.__setEffect('replaygain', True)
 
 
     def disableReplayGain(self):
-        """ Disable the replay gain element, if any """
-        self.__saveRestoreState(self.__disableReplayGain)
+        """ Remove the replay gain element from the audio chain """
+        self.__setEffect('replaygain', False)
+
+
+    def __setEqualizerLvls(self, equalizer, lvls):
+        """ Set the level of the 10-bands of the given equalizer """
+        for i in xrange(10):
+            equalizer.set_property('band%u' % i, lvls[i])
 
 
     def setEqualizerLvls(self, lvls):
         """ Set the level of the 10-bands of the equalizer (levels must be a list/tuple with 10 values lying between -24 and +12) """
-        if len(lvls) == 10 and self.equalizer is not None:
-            self.equalizer.set_property('band0', lvls[0])
-            self.equalizer.set_property('band1', lvls[1])
-            self.equalizer.set_property('band2', lvls[2])
-            self.equalizer.set_property('band3', lvls[3])
-            self.equalizer.set_property('band4', lvls[4])
-            self.equalizer.set_property('band5', lvls[5])
-            self.equalizer.set_property('band6', lvls[6])
-            self.equalizer.set_property('band7', lvls[7])
-            self.equalizer.set_property('band8', lvls[8])
-            self.equalizer.set_property('band9', lvls[9])
+        if len(lvls) == 10:
+            self.eqzLvls = lvls
+
+            for player in (self.player, self.nextPlayer):
+                if player is not None:
+                    equalizer = self.__getElement(player, 'equalizer')
+                    if equalizer is not None:
+                        self.__setEqualizerLvls(equalizer, lvls)
+
+
+    # --== Playback ==--
 
 
     def isPaused(self):
         """ Return whether the player is paused """
-        return self.player.get_state()[1] == gst.STATE_PAUSED
+        return self.state == PLAYER_PAUSED
 
 
     def isPlaying(self):
-        """ Return whether the player is paused """
-        return self.player.get_state()[1] == gst.STATE_PLAYING
+        """ Return whether the player is playing (or about to) """
+        return self.state == PLAYER_PLAYING or self.state == PLAYER_STARTING
 
 
-    def setURI(self, uri):
-        """ Play the given URI """
-        self.player.set_property('uri', uri.replace('#', '%23'))
+    def playURI(self, uri):
+        """ Play the given URI, if the pipeline has not yet started playing the previous one, only the last requested URI is played """
+        uri = uri.replace('#', '%23')
+
+        # Nothing to do if the player has already switched to this URI at the end of the previous track
+        if uri == self.chainedURI and self.state != PLAYER_STOPPED:
+            self.chainedURI = None
+            return
+
+        self.chainedURI = None
+
+        if uri == self.nextURI:
+            self.__switchToNextURI()
+        else:
+            self.clearNextURI()
+            self.pendingURI = uri
+            if self.state != PLAYER_STARTING:
+                self.__startPendingURI()
 
 
     def play(self):
         """ Play """
+        self.state = PLAYER_PLAYING
         self.player.set_state(gst.STATE_PLAYING)
 
 
     def pause(self):
         """ Pause """
+        if self.pendingURI is not None:
+            self.player.set_state(gst.STATE_READY)
+            self.player.set_property('uri', self.pendingURI)
+            self.pendingURI = None
+
+        # The end of the previous track is not resumed
+        self.__dropFadingPipeline()
+
+        self.state = PLAYER_PAUSED
         self.player.set_state(gst.STATE_PAUSED)
 
 
     def stop(self):
         """ Stop playing """
+        self.__cancelNeedNext()
+        self.__cancelCrossfade()
+        self.__dropFadingPipeline()
+        self.state      = PLAYER_STOPPED
+        self.pendingURI = None
+        self.chainedURI = None
         self.player.set_state(gst.STATE_NULL)
 
 
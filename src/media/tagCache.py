@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Ingelrest François (Francois.Ingelrest@gmail.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import cPickle, threading, tools, traceback
+
+from tools       import consts
+from tools.log   import logger
+from media.track import TAG_PLP, TAG_PLL
+
+
+VERSION = 1   # Used to enforce compatibility
+
+# Information associated with each cached file
+(
+    CACHE_MTIME,   # Modification time of the file when its tags were extracted
+    CACHE_SIZE,    # Size of the file when its tags were extracted
+    CACHE_TAGS     # The tags themselves
+) = range(3)
+
+
+__cache    = None              # Cached tags for each file, loaded from the disk on first use
+__mutex    = threading.Lock()  # Tags may be extracted by several threads at the same time
+__modified = False             # True if the cache must be written back to the disk
+
+
+def __load():
+    """ Load the cache from the disk if needed, must be called with the mutex held """
+    global __cache
+
+    if __cache is None:
+        try:
+            version, __cache = tools.pickleLoad(consts.fileTagCache)
+            if version != VERSION:
+                __cache = {}
+        except:
+            __cache = {}
+
+
+def get(file, fileStat):
+    """ Return a copy of the cached tags of the given file, or None if they are not known or if the file has been modified since then """
+    __mutex.acquire()
+    __load()
+    entry = __cache.get(file, None)
+    __mutex.release()
+
+    if entry is None or entry[CACHE_MTIME] != fileStat.st_mtime or entry[CACHE_SIZE] != fileStat.st_size:
+        return None
+
+    return entry[CACHE_TAGS].copy()
+
+
+def set(file, fileStat, tags):
+    """ Store the tags of the given file, fileStat being the result of os.stat() before the tags were extracted """
+    global __modified
+
+    # Tags related to the tracklist are not properties of the file
+    tags = tags.copy()
+    for tag in (TAG_PLP, TAG_PLL):
+        if tag in tags:
+            del tags[tag]
+
+    __mutex.acquire()
+    __load()
+    __cache[file] = (fileStat.st_mtime, fileStat.st_size, tags)
+    __modified    = True
+    __mutex.release()
+
+
+def remove(files):
+    """ Remove the given files from the cache, e.g., when they are known to have been deleted or moved """
+    global __modified
+
+    __mutex.acquire()
+    __load()
+    for file in files:
+        if file in __cache:
+            del __cache[file]
+            __modified = True
+    __mutex.release()
+
+
+def save():
+    """ Write the cache back to the disk if it has been modified """
+    global __modified
+
+    __mutex.acquire()
+    try:
+        if __modified:
+            tools.pickleSave(consts.fileTagCache, (VERSION, __cache), cPickle.HIGHEST_PROTOCOL)
+            __modified = False
+    except:
+        logger.error('Unable to save the tag cache to %s\n\n%s' % (consts.fileTagCache, traceback.format_exc()))
+    __mutex.release()
@@ -16,7 +16,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import cgi, urllib
+import cgi, marshal, re, urllib
 
 from tools   import consts, sec2str
 from gettext import gettext as _
@@ -40,6 +40,14 @@ from gettext import gettext as _
     TAG_PLL,  # Length of the playlist
 ) = range(14)
 
+NB_TAGS       = 14                                                      # Number of known tags
+INT_TAGS      = (TAG_NUM, TAG_LEN, TAG_DNB, TAG_DAT, TAG_PLP, TAG_PLL)  # Tags with an integer value
+INTERNED_TAGS = (TAG_ART, TAG_ALB, TAG_AAR, TAG_GEN)                    # Values shared by many tracks, a single copy of each of them is kept in memory
+
+# Binary format of lists of tracks
+LIST_MAGIC    = 'DAP-TRACKLIST'   # Identifies the binary format
+LIST_VERSION  = 1                 # Used to enforce compatibility
+
 
 # Special fields that may be used to call format()
 FIELDS = (
@@ -58,6 +66,26 @@ FIELDS = (
          )
 
 
+# For each special field: the function returning its value for a given track, and whether it must be escaped to be HTML safe
+FIELDS_VALUES = {
+                    'track'       : (lambda track: str(track.getNumber()),      False),
+                    'title'       : (lambda track: track.getTitle(),            True),
+                    'artist'      : (lambda track: track.getArtist(),           True),
+                    'album'       : (lambda track: track.getAlbum(),            True),
+                    'genre'       : (lambda track: track.getGenre(),            True),
+                    'date'        : (lambda track: str(track.getDate()),        False),
+                    'disc'        : (lambda track: str(track.getDiscNumber()),  False),
+                    'duration_sec': (lambda track: str(track.getLength()),      False),
+                    'duration_str': (lambda track: sec2str(track.getLength()),  False),
+                    'playlist_pos': (lambda track: str(track.getPlaylistPos()), False),
+                    'playlist_len': (lambda track: str(track.getPlaylistLen()), False),
+                    'path'        : (lambda track: track.getFilePath(),         True),
+                }
+
+# Used to split a format string into literal strings and special fields
+FIELDS_REGEXP = re.compile('{(%s)}' % '|'.join(FIELDS_VALUES.keys()))
+
+
 def getFormatSpecialFields(usePango=True):
     """
         Return a string in plain English (or whatever language being used) giving the special fields that may be used to call Track.format()
@@ -67,52 +95,66 @@ def getFormatSpecialFields(usePango=True):
     else:        return '\n'.join(['%s\t%s' % (field.ljust(14), desc) for (field, desc) in FIELDS])
 
 
-class Track:
-    """ A track and its associated tags """
+class Track(object):
+    """
+        A track and its associated tags
+        Tags are stored in a list indexed by their identifier, None meaning that a tag is not set
+    """
+
+    __slots__   = ('values',)
+    __templates = {}           # Compiled format strings, shared by all tracks
+
 
     def __init__(self, resource=None, scheme=None):
         """ Constructor """
-        self.tags = {}
-
-        if scheme is not None:   self.tags[TAG_SCH] = scheme
-        if resource is not None: self.tags[TAG_RES] = resource
-
-
-    def setNumber(self, nb):               self.tags[TAG_NUM] = nb
-    def setTitle(self, title):             self.tags[TAG_TIT] = title
-    def setArtist(self, artist):           self.tags[TAG_ART] = artist
-    def setAlbum(self, album):             self.tags[TAG_ALB] = album
-    def setLength(self, length):           self.tags[TAG_LEN] = length
-    def setAlbumArtist(self, albumArtist): self.tags[TAG_AAR] = albumArtist
-    def setDiscNumber(self, discNumber):   self.tags[TAG_DNB] = discNumber
-    def setGenre(self, genre):             self.tags[TAG_GEN] = genre
-    def setDate(self, date):               self.tags[TAG_DAT] = date
-    def setMBTrackId(self, id):            self.tags[TAG_MBT] = id
-    def setPlaylistPos(self, pos):         self.tags[TAG_PLP] = pos
-    def setPlaylistLen(self, len):         self.tags[TAG_PLL] = len
-
-
-    def hasNumber(self):      return TAG_NUM in self.tags
-    def hasTitle(self):       return TAG_TIT in self.tags
-    def hasArtist(self):      return TAG_ART in self.tags
-    def hasAlbum(self):       return TAG_ALB in self.tags
-    def hasLength(self):      return TAG_LEN in self.tags
-    def hasAlbumArtist(self): return TAG_AAR in self.tags
-    def hasDiscNumber(self):  return TAG_DNB in self.tags
-    def hasGenre(self):       return TAG_GEN in self.tags
-    def hasDate(self):        return TAG_DAT in self.tags
-    def hasMBTrackId(self):   return TAG_MBT in self.tags
-    def hasPlaylistPos(self): return TAG_PLP in self.tags
-    def hasPlaylistLen(self): return TAG_PLL in self.tags
+        self.values          = [None] * NB_TAGS
+        self.values[TAG_SCH] = scheme
+        self.values[TAG_RES] = resource
+
+
+    def __intern(self, value):
+        """ Return the shared copy of the given string """
+        if type(value) is str: return intern(value)
+        else:                  return value
+
+
+    def setNumber(self, nb):               self.values[TAG_NUM] = nb
+    def setTitle(self, title):             self.values[TAG_TIT] = title
+    def setArtist(self, artist):           self.values[TAG_ART] = self.__intern(artist)
+    def setAlbum(self, album):             self.values[TAG_ALB] = self.__intern(album)
+    def setLength(self, length):           self.values[TAG_LEN] = length
+    def setAlbumArtist(self, albumArtist): self.values[TAG_AAR] = self.__intern(albumArtist)
+    def setDiscNumber(self, discNumber):   self.values[TAG_DNB] = discNumber
+    def setGenre(self, genre):             self.values[TAG_GEN] = self.__intern(genre)
+    def setDate(self, date):               self.values[TAG_DAT] = date
+    def setMBTrackId(self, id):            self.values[TAG_MBT] = id
+    def setPlaylistPos(self, pos):         self.values[TAG_PLP] = pos
+    def setPlaylistLen(self, len):         self.values[TAG_PLL] = len
+
+
+    def hasNumber(self):      return self.values[TAG_NUM] is not None
+    def hasTitle(self):       return self.values[TAG_TIT] is not None
+    def hasArtist(self):      return self.values[TAG_ART] is not None
+    def hasAlbum(self):       return self.values[TAG_ALB] is not None
+    def hasLength(self):      return self.values[TAG_LEN] is not None
+    def hasAlbumArtist(self): return self.values[TAG_AAR] is not None
+    def hasDiscNumber(self):  return self.values[TAG_DNB] is not None
+    def hasGenre(self):       return self.values[TAG_GEN] is not None
+    def hasDate(self):        return self.values[TAG_DAT] is not None
+    def hasMBTrackId(self):   return self.values[TAG_MBT] is not None
+    def hasPlaylistPos(self): return self.values[TAG_PLP] is not None
+    def hasPlaylistLen(self): return self.values[TAG_PLL] is not None
 
 
     def __get(self, tag, defaultValue):
         """ Return the value of tag if it exists, or return defaultValue """
-        try:    return self.tags[tag]
-        except: return defaultValue
+        value = self.values[tag]
 
+        if value is None: return defaultValue
+        else:             return value
 
-    def getFilePath(self):    return self.tags[TAG_RES]
+
+    def getFilePath(self):    return self.values[TAG_RES]
     def getNumber(self):      return self.__get(TAG_NUM, consts.UNKNOWN_TRACK_NUMBER)
     def getTitle(self):       return self.__get(TAG_TIT, consts.UNKNOWN_TITLE)
     def getArtist(self):      return self.__get(TAG_ART, consts.UNKNOWN_ARTIST)
@@ -137,7 +179,7 @@ class Track:
 
     def getURI(self):
         """ Return the complete URI to the resource """
-        try:    return self.tags[TAG_SCH] + '://' + self.tags[TAG_RES]
+        try:    return self.values[TAG_SCH] + '://' + self.values[TAG_RES]
         except: raise RuntimeError, 'The track is an unknown type of resource'
 
 
@@ -182,24 +224,41 @@ class Track:
         return cmp(self.getFilePath(), track.getFilePath())
 
 
-    def format(self, fmtString):
-        """ Replace the special fields in the given string by their corresponding value """
-        result = fmtString
+    def __getTemplate(self, fmtString, htmlSafe):
+        """
+            Return the compiled version of the given format string: a list alternating literal strings and tuples (function, escape)
+            Format strings are compiled only once, since there are only a few of them (i.e., the user's preferences)
+        """
+        key = (fmtString, htmlSafe)
+
+        if key not in self.__templates:
+            template = FIELDS_REGEXP.split(fmtString)
+
+            for i in xrange(1, len(template), 2):
+                getter, escape = FIELDS_VALUES[template[i]]
+                template[i]    = (getter, escape and htmlSafe)
+
+            self.__templates[key] = template
 
-        result = result.replace( '{path}',         self.getFilePath()         )
-        result = result.replace( '{album}',        self.getAlbum()            )
-        result = result.replace( '{track}',        str(self.getNumber())      )
-        result = result.replace( '{title}',        self.getTitle()            )
-        result = result.replace( '{artist}',       self.getArtist()           )
-        result = result.replace( '{genre}',        self.getGenre()            )
-        result = result.replace( '{date}',         str(self.getDate())        )
-        result = result.replace( '{disc}',         str(self.getDiscNumber())  )
-        result = result.replace( '{duration_sec}', str(self.getLength())      )
-        result = result.replace( '{duration_str}', sec2str(self.getLength())  )
-        result = result.replace( '{playlist_pos}', str(self.getPlaylistPos()) )
-        result = result.replace( '{playlist_len}', str(self.getPlaylistLen()) )
+        return self.__templates[key]
 
-        return result
+
+    def __format(self, fmtString, htmlSafe):
+        """ Replace the special fields in the given string by their corresponding value, only the fields actually used are evaluated """
+        result = list(self.__getTemplate(fmtString, htmlSafe))
+
+        for i in xrange(1, len(result), 2):
+            getter, escape = result[i]
+
+            if escape: result[i] = cgi.escape(getter(self))
+            else:      result[i] = getter(self)
+
+        return ''.join(result)
+
+
+    def format(self, fmtString):
+        """ Replace the special fields in the given string by their corresponding value """
+        return self.__format(fmtString, False)
 
 
     def formatHTMLSafe(self, fmtString):
@@ -207,40 +266,43 @@ class Track:
             Replace the special fields in the given string by their corresponding value
             Also ensure that the fields don't contain HTML special characters (&, <, >)
         """
-        result = fmtString
-
-        result = result.replace( '{path}',         cgi.escape(self.getFilePath()) )
-        result = result.replace( '{album}',        cgi.escape(self.getAlbum())    )
-        result = result.replace( '{track}',        str(self.getNumber())          )
-        result = result.replace( '{title}',        cgi.escape(self.getTitle())    )
-        result = result.replace( '{artist}',       cgi.escape(self.getArtist())   )
-        result = result.replace( '{genre}',        cgi.escape(self.getGenre())    )
-        result = result.replace( '{date}',         str(self.getDate())            )
-        result = result.replace( '{disc}',         str(self.getDiscNumber())      )
-        result = result.replace( '{duration_sec}', str(self.getLength())          )
-        result = result.replace( '{duration_str}', sec2str(self.getLength())      )
-        result = result.replace( '{playlist_pos}', str(self.getPlaylistPos())     )
-        result = result.replace( '{playlist_len}', str(self.getPlaylistLen())     )
-
-        return result
+        return self.__format(fmtString, True)
 
 
     def getTags(self):
-        """ Return the disctionary of tags """
-        return self.tags
+        """ Return a dictionary with the tags that are set """
+        return dict([(tag, value) for (tag, value) in enumerate(self.values) if value is not None])
 
 
     def setTags(self, tags):
-        """ Set the disctionary of tags """
-        self.tags = tags
+        """ Replace all tags with the given dictionary """
+        self.values = [None] * NB_TAGS
+
+        for tag, value in tags.iteritems():
+            if tag in INTERNED_TAGS: self.values[tag] = self.__intern(value)
+            else:                    self.values[tag] = value
+
+
+    def __getstate__(self):
+        """ Tags are pickled as a dictionary, the format used before the introduction of __slots__ """
+        return {'tags': self.getTags()}
+
+
+    def __setstate__(self, state):
+        """
+            Restore the tags from a pickled dictionary
+            Instances pickled before the introduction of __slots__ are created by calling the class without argument before this method is called
+        """
+        self.setTags(state['tags'])
 
 
     def serialize(self):
         """ Serialize this Track object, return the corresponding string """
         tags = []
-        for tag, value in self.tags.iteritems():
-            tags.append(str(tag))
-            tags.append(urllib.quote(str(value)))
+        for tag, value in enumerate(self.values):
+            if value is not None:
+                tags.append(str(tag))
+                tags.append(urllib.quote(str(value)))
         return ' '.join(tags)
 
 
@@ -250,8 +312,9 @@ class Track:
         for i in xrange(0, len(tags), 2):
             tag = int(tags[i])
 
-            if tag in (TAG_NUM, TAG_LEN, TAG_DNB, TAG_DAT, TAG_PLP, TAG_PLL): self.tags[tag] = int(tags[i+1])
-            else:                                                             self.tags[tag] = urllib.unquote(tags[i+1])
+            if tag in INT_TAGS:        self.values[tag] = int(tags[i+1])
+            elif tag in INTERNED_TAGS: self.values[tag] = self.__intern(urllib.unquote(tags[i+1]))
+            else:                      self.values[tag] = urllib.unquote(tags[i+1])
 
 
 def unserialize(serialTrack):
@@ -259,3 +322,30 @@ def unserialize(serialTrack):
     t = Track()
     t.unserialize(serialTrack)
     return t
+
+
+def isSerializedList(data):
+    """ Return True if the given string has been created by serializeList() """
+    return data.startswith(LIST_MAGIC)
+
+
+def serializeList(tracks):
+    """ Return a compact binary representation of the given list of tracks """
+    return LIST_MAGIC + chr(LIST_VERSION) + marshal.dumps([track.values for track in tracks], 2)
+
+
+def unserializeList(data):
+    """ Return the list of Track objects corresponding to the given binary representation (see serializeList()) """
+    if not isSerializedList(data):
+        raise ValueError, 'Not a serialized list of tracks'
+
+    if ord(data[len(LIST_MAGIC)]) != LIST_VERSION:
+        raise ValueError, 'Unsupported version of serialized list of tracks'
+
+    tracks = []
+    for values in marshal.loads(data[len(LIST_MAGIC)+1:]):
+        track        = Track.__new__(Track)
+        track.values = values + [None] * (NB_TAGS - len(values))
+        tracks.append(track)
+
+    return tracks
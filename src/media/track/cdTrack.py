@@ -21,6 +21,9 @@ from media.track import Track
 class CDTrack(Track):
     """ A Track that has been created from an audio CD """
 
-    def __init__(self, resource):
+    __slots__ = ()
+
+
+    def __init__(self, resource=None):
         """ Constructor """
         Track.__init__(self, resource, 'cdda')
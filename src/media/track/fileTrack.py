@@ -21,6 +21,9 @@ from media.track import Track
 class FileTrack(Track):
     """ A Track that has been created from a file """
 
-    def __init__(self, resource):
+    __slots__ = ()
+
+
+    def __init__(self, resource=None):
         """ Constructor """
         Track.__init__(self, resource, 'file')
@@ -16,13 +16,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import media, modules, os.path, tools, traceback
+import media, modules, os.path, threading, tools, traceback
 
 from tools import consts, log, prefs
 
 MOD_INFO = ('Command Line Support', 'Command Line Support', '', [], True, False)
 MOD_NAME = MOD_INFO[modules.MODINFO_NAME]
 
+SAVE_DELAY = 2.0   # The tracklist is saved once it has not been modified for this number of seconds
+
 
 class CommandLine(modules.ThreadedModule):
 
@@ -34,6 +36,9 @@ class CommandLine(modules.ThreadedModule):
     def onAppStarted(self):
         """ Try to fill the playlist by using the files given on the command line or by restoring the last playlist """
         (options, args)    = prefs.getCmdLine()
+        self.saveLock      = threading.Lock()
+        self.saveTimer     = None
+        self.pendingTracks = None
         self.savedPlaylist = os.path.join(consts.dirCfg, 'saved-playlist.txt')
 
         if len(args) != 0:
@@ -41,19 +46,69 @@ class CommandLine(modules.ThreadedModule):
             modules.postMsg(consts.MSG_CMD_TRACKLIST_SET, {'tracks': media.getTracks(args), 'playNow': True})
         else:
             try:
-                tracks = [media.track.unserialize(serialTrack) for serialTrack in tools.pickleLoad(self.savedPlaylist)]
+                input = open(self.savedPlaylist, 'rb')
+                data  = input.read()
+                input.close()
+
+                # Playlists saved by older versions are pickled lists of serialized tracks
+                if media.track.isSerializedList(data): tracks = media.track.unserializeList(data)
+                else:                                  tracks = [media.track.unserialize(serialTrack) for serialTrack in tools.pickleLoad(self.savedPlaylist)]
+
                 modules.postMsg(consts.MSG_CMD_TRACKLIST_SET, {'tracks': tracks, 'playNow': False})
                 log.logger.info('[%s] Restored playlist' % MOD_NAME)
             except:
                 log.logger.error('[%s] Unable to restore playlist from %s\n\n%s' % (MOD_NAME, self.savedPlaylist, traceback.format_exc()))
 
 
+    def scheduleSave(self, tracks):
+        """ Save the given tracklist once it has not been modified for SAVE_DELAY seconds """
+        self.saveLock.acquire()
+
+        if self.saveTimer is not None:
+            self.saveTimer.cancel()
+
+        self.pendingTracks = tracks
+        self.saveTimer     = threading.Timer(SAVE_DELAY, self.savePlaylist)
+        self.saveTimer.setDaemon(True)
+        self.saveTimer.start()
+
+        self.saveLock.release()
+
+
+    def savePlaylist(self):
+        """ Save the pending tracklist, if any, the file is replaced atomically so that it is never left incomplete """
+        self.saveLock.acquire()
+
+        if self.pendingTracks is not None:
+            try:
+                tmpFile = self.savedPlaylist + '.tmp'
+                output  = open(tmpFile, 'wb')
+                output.write(media.track.serializeList(self.pendingTracks))
+                output.close()
+                os.rename(tmpFile, self.savedPlaylist)
+            except:
+                log.logger.error('[%s] Unable to save playlist to %s\n\n%s' % (MOD_NAME, self.savedPlaylist, traceback.format_exc()))
+
+            self.pendingTracks = None
+
+        self.saveLock.release()
+
+
+    def onAppQuit(self):
+        """ Save the pending tracklist right now """
+        self.saveLock.acquire()
+        if self.saveTimer is not None:
+            self.saveTimer.cancel()
+        self.saveLock.release()
+
+        self.savePlaylist()
+
+
     # --== Message handler ==--
 
 
     def handleMsg(self, msg, params):
         """ Handle messages sent to this modules """
-        if msg == consts.MSG_EVT_NEW_TRACKLIST:
-            tools.pickleSave(self.savedPlaylist, [track.serialize() for track in params['tracks']])
-        elif msg == consts.MSG_EVT_APP_STARTED:
-            self.onAppStarted()
+        if   msg == consts.MSG_EVT_NEW_TRACKLIST:                                  self.scheduleSave(params['tracks'])
+        elif msg == consts.MSG_EVT_APP_STARTED:                                    self.onAppStarted()
+        elif msg == consts.MSG_EVT_APP_QUIT or msg == consts.MSG_EVT_MOD_UNLOADED: self.onAppQuit()
@@ -16,11 +16,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import gui, Image, modules, os, socket, tempfile, tools, traceback, urllib2
+import cPickle, gui, hashlib, Image, modules, os, Queue, shutil, socket, tempfile, threading, tools, traceback, urllib2
 
-from tools     import consts, prefs
-from gettext   import gettext as _
-from tools.log import logger
+from tools       import consts, prefs
+from collections import OrderedDict
+from gettext     import gettext as _
+from tools.log   import logger
 
 
 # Module information
@@ -51,6 +52,27 @@ THUMBNAIL_OFFSETY =   3  # Y-offset to render the thumbnail in the model
 FULL_SIZE_COVER_WIDTH  = 300
 FULL_SIZE_COVER_HEIGHT = 300
 
+# Thumbnails and full size covers are generated by a pool of threads
+IMG_NB_WORKERS = 2
+
+# Priorities of the jobs given to the workers (the lower, the more urgent)
+(
+    IMG_PRIO_STOP,      # The worker must exit
+    IMG_PRIO_CURRENT,   # Covers of the current track
+    IMG_PRIO_PREFETCH   # Covers of the upcoming tracks
+) = range(3)
+
+# The manifest lists the covers downloaded from the Internet, it is loaded once and written back whenever it is modified
+CACHE_VERSION  = 1                    # Used to enforce compatibility
+CACHE_MANIFEST = 'MANIFEST'           # Name of the manifest in the cache directory
+CACHE_MAX_SIZE = 32 * 1024 * 1024     # Least recently used covers are removed beyond this number of bytes
+
+# Information stored in the manifest for each cached cover
+(
+    CACHE_FILENAME,   # Name of the image in the cache directory
+    CACHE_SIZE        # Size of the image in bytes
+) = range(2)
+
 # File formats we can read
 ACCEPTED_FILE_FORMATS = {'.jpg': None, '.jpeg': None, '.png': None, '.gif': None}
 
@@ -69,7 +91,7 @@ class Covers(modules.ThreadedModule):
     def __init__(self):
         """ Constructor """
         modules.ThreadedModule.__init__(self, (consts.MSG_EVT_MOD_LOADED,   consts.MSG_EVT_APP_STARTED, consts.MSG_EVT_NEW_TRACK,
-                                               consts.MSG_EVT_MOD_UNLOADED, consts.MSG_EVT_APP_QUIT))
+                                               consts.MSG_EVT_MOD_UNLOADED, consts.MSG_EVT_APP_QUIT,    consts.MSG_EVT_UPCOMING_TRACKS))
 
 
     def onModLoaded(self):
@@ -79,15 +101,42 @@ class Covers(modules.ThreadedModule):
         self.currTrack      = None                                   # The current track being played, if any
         self.cacheRootPath  = os.path.join(consts.dirCfg, MOD_NAME)  # Local cache for Internet covers
         self.coverBlacklist = {}                                     # When a cover cannot be downloaded, avoid requesting it again
+        self.coverLock      = threading.Lock()                       # The cover map is shared with the workers
+        self.cacheLock      = threading.Lock()                       # So are the manifest of the cache and the blacklist
+        self.imgJobs        = Queue.PriorityQueue(0)                 # Images to be processed by the workers
+        self.imgJobId       = 0                                      # Jobs with the same priority are processed in order
+        self.prefetchId     = 0                                      # Incremented when the current or upcoming tracks change
+        self.imgWorkers     = []                                     # Threads generating thumbnails and full size covers
 
         if not os.path.exists(self.cacheRootPath):
             os.mkdir(self.cacheRootPath)
 
+        self.loadCache()
+
+        # The images used to generate thumbnails never change
+        self.thumbnailGlow  = Image.open(THUMBNAIL_GLOW).convert('RGBA')
+        self.thumbnailModel = Image.open(THUMBNAIL_MODEL).convert('RGBA')
+
+        for i in xrange(IMG_NB_WORKERS):
+            worker = threading.Thread(target=self.__imgWorker)
+            worker.setDaemon(True)
+            worker.start()
+            self.imgWorkers.append(worker)
+
 
     def onModUnloaded(self):
         """ The module has been unloaded """
         if self.currTrack is not None:
             modules.postMsg(consts.MSG_CMD_SET_COVER, {'track': self.currTrack, 'pathThumbnail': None, 'pathFullSize': None})
+            self.currTrack = None
+
+        # Stop the workers, pending jobs are discarded
+        for worker in self.imgWorkers:
+            self.__addImgJob(IMG_PRIO_STOP, None, None, None, None)
+        for worker in self.imgWorkers:
+            worker.join()
+
+        self.saveCache()
 
         # Delete covers that have been generated by this module
         for covers in self.coverMap.itervalues():
@@ -146,13 +195,12 @@ class Covers(modules.ThreadedModule):
             cover = cover.resize((newWidth, newHeight), Image.ANTIALIAS)
 
             # Paste the resized cover into our model
-            model = Image.open(THUMBNAIL_MODEL).convert('RGBA')
+            model = self.thumbnailModel.copy()
             model.paste(cover, (THUMBNAIL_OFFSETX + offsetX, THUMBNAIL_OFFSETY + offsetY), cover)
             cover = model
 
             # Add the glow effect
-            glow = Image.open(THUMBNAIL_GLOW).convert('RGBA')
-            cover.paste(glow, (0, 0), glow)
+            cover.paste(self.thumbnailGlow, (0, 0), self.thumbnailGlow)
 
             # We're done
             cover.save(outFile, format)
@@ -160,6 +208,54 @@ class Covers(modules.ThreadedModule):
             logger.error('[%s] An error occurred while generating a thumbnail\n\n%s' % (MOD_NAME, traceback.format_exc()))
 
 
+    def __addImgJob(self, priority, track, coverKey, rawCover, prefetchId):
+        """
+            Ask the workers to generate the thumbnail and the full size cover of the given track from rawCover
+            If rawCover is None, the cover is first downloaded, unless the upcoming tracks have changed since prefetchId
+        """
+        self.imgJobId += 1
+        self.imgJobs.put((priority, self.imgJobId, track, coverKey, rawCover, prefetchId))
+
+
+    def __imgWorker(self):
+        """ Generate thumbnails and full size covers until asked to stop """
+        while True:
+            (priority, jobId, track, coverKey, rawCover, prefetchId) = self.imgJobs.get()
+
+            if priority == IMG_PRIO_STOP:
+                break
+
+            if rawCover is None:
+                # Don't waste time and bandwidth on tracks that may not be played next anymore
+                if prefetchId != self.prefetchId:
+                    continue
+
+                rawCover = self.getFromInternet(track.getArtist().lower(), track.getAlbum().lower())
+                if rawCover is None:
+                    continue
+
+            self.coverLock.acquire()
+            covers = self.coverMap.get(coverKey, None)
+            self.coverLock.release()
+
+            if covers is None:
+                thumbnail     = tempfile.mktemp() + '.png'
+                fullSizeCover = tempfile.mktemp() + '.png'
+                self.generateThumbnail(rawCover, thumbnail, 'PNG')
+                self.generateFullSizeCover(rawCover, fullSizeCover, 'PNG')
+
+                if os.path.exists(thumbnail) and os.path.exists(fullSizeCover):
+                    covers = (thumbnail, fullSizeCover)
+                    self.coverLock.acquire()
+                    self.coverMap[coverKey] = covers
+                    self.coverLock.release()
+
+            # The user may have skipped to another track in the meantime
+            if track is self.currTrack:
+                if covers is None: modules.postMsg(consts.MSG_CMD_SET_COVER, {'track': track, 'pathThumbnail': None,              'pathFullSize': None})
+                else:              modules.postMsg(consts.MSG_CMD_SET_COVER, {'track': track, 'pathThumbnail': covers[CVR_THUMB], 'pathFullSize': covers[CVR_FULL]})
+
+
     def getUserCover(self, trackPath):
         """
             Check whether a user cover (e.g., cover.jpg) exists in the given directory:
@@ -168,28 +264,119 @@ class Covers(modules.ThreadedModule):
         """
         userCoverFilenames = prefs.get(__name__, 'user-cover-filenames', PREFS_DFT_USER_COVER_FILENAMES)
 
-        for (file, path) in tools.listDir(trackPath, True):
-            (name, ext) = os.path.splitext(file.lower())
+        for entry in tools.listDir(trackPath, True):
+            (name, ext) = os.path.splitext(entry.name.lower())
             if ext in ACCEPTED_FILE_FORMATS and name in userCoverFilenames:
-                return path
+                return entry.path
 
         return None
 
 
-    def getFromCache(self, artist, album):
-        """ Return the path to the cached cover, or None if it's not cached """
-        cachePath    = os.path.join(self.cacheRootPath, str(abs(hash(artist))))
-        cacheIdxPath = os.path.join(cachePath, 'INDEX')
+    def getCacheKey(self, artist, album):
+        """ Return the key of the given album in the cache, which does not depend on the Python interpreter (unlike hash()) """
+        coverKey = artist + album
+
+        if isinstance(coverKey, unicode):
+            coverKey = coverKey.encode('utf-8')
+
+        return hashlib.md5(coverKey).hexdigest()
+
+
+    def loadCache(self):
+        """ Load the manifest of the cache, importing covers stored in the old format (one directory and one index per artist) if needed """
+        self.cacheSize     = 0
+        self.cacheManifest = OrderedDict()   # Least recently used covers come first
+        self.cacheModified = False
 
         try:
-            cacheIdx = tools.pickleLoad(cacheIdxPath)
-            cover    = os.path.join(cachePath, cacheIdx[artist + album])
-            if os.path.exists(cover):
-                return cover
+            version, self.cacheManifest = tools.pickleLoad(os.path.join(self.cacheRootPath, CACHE_MANIFEST))
+            if version != CACHE_VERSION:
+                self.cacheManifest = OrderedDict()
         except:
             pass
 
-        return None
+        for entry in tools.listDir(self.cacheRootPath, True):
+            if not entry.isDir:
+                continue
+
+            try:
+                for (coverKey, filename) in tools.pickleLoad(os.path.join(entry.path, 'INDEX')).iteritems():
+                    oldPath = os.path.join(entry.path, filename)
+                    if os.path.exists(oldPath):
+                        filename = self.getCacheKey(coverKey, '') + os.path.splitext(filename)[1]
+                        shutil.move(oldPath, os.path.join(self.cacheRootPath, filename))
+                        self.cacheManifest[self.getCacheKey(coverKey, '')] = (filename, os.path.getsize(os.path.join(self.cacheRootPath, filename)))
+                        self.cacheModified = True
+            except:
+                logger.error('[%s] Unable to import cached covers from %s\n\n%s' % (MOD_NAME, entry.path, traceback.format_exc()))
+
+            shutil.rmtree(entry.path, True)
+
+        # Covers may have been cached without the manifest being written (e.g., crash), they are considered as the least recently used ones
+        missingCovers = []
+        knownCovers   = set([cover[CACHE_FILENAME] for cover in self.cacheManifest.itervalues()])
+
+        for entry in tools.listDir(self.cacheRootPath, True):
+            if entry.isFile and entry.name != CACHE_MANIFEST and entry.name not in knownCovers:
+                missingCovers.append((os.path.splitext(entry.name)[0], (entry.name, os.path.getsize(entry.path))))
+
+        if len(missingCovers) != 0:
+            missingCovers.extend(self.cacheManifest.items())
+            self.cacheManifest = OrderedDict(missingCovers)
+            self.cacheModified = True
+
+        for cover in self.cacheManifest.itervalues():
+            self.cacheSize += cover[CACHE_SIZE]
+
+        self.shrinkCache()
+        self.saveCache()
+
+
+    def saveCache(self):
+        """ Write the manifest of the cache back to the disk if it has been modified, must be called with the cache lock held (if needed) """
+        if self.cacheModified:
+            try:
+                tools.pickleSave(os.path.join(self.cacheRootPath, CACHE_MANIFEST), (CACHE_VERSION, self.cacheManifest), cPickle.HIGHEST_PROTOCOL)
+                self.cacheModified = False
+            except:
+                logger.error('[%s] Unable to save the manifest of the cache\n\n%s' % (MOD_NAME, traceback.format_exc()))
+
+
+    def shrinkCache(self):
+        """ Remove the least recently used covers until the cache fits into CACHE_MAX_SIZE, must be called with the cache lock held (if needed) """
+        while self.cacheSize > CACHE_MAX_SIZE:
+            cacheKey, cover = self.cacheManifest.popitem(False)
+            self.cacheSize    -= cover[CACHE_SIZE]
+            self.cacheModified = True
+
+            try:    os.remove(os.path.join(self.cacheRootPath, cover[CACHE_FILENAME]))
+            except: pass
+
+
+    def getFromCache(self, artist, album):
+        """ Return the path to the cached cover, or None if it's not cached """
+        cacheKey  = self.getCacheKey(artist, album)
+        coverPath = None
+
+        self.cacheLock.acquire()
+
+        cover = self.cacheManifest.pop(cacheKey, None)
+        if cover is not None:
+            coverPath = os.path.join(self.cacheRootPath, cover[CACHE_FILENAME])
+
+            # The cover is now the most recently used one, the new order is written back when the module is unloaded
+            if os.path.exists(coverPath):
+                self.cacheManifest[cacheKey] = cover
+                self.cacheModified           = True
+            else:
+                coverPath          = None
+                self.cacheSize    -= cover[CACHE_SIZE]
+                self.cacheModified = True
+                self.saveCache()
+
+        self.cacheLock.release()
+
+        return coverPath
 
 
     def __getFromInternet(self, artist, album):
@@ -246,29 +433,34 @@ class Covers(modules.ThreadedModule):
             return None
 
         # So far, so good: let's cache the image
-        cachePath    = os.path.join(self.cacheRootPath, str(abs(hash(artist))))
-        cacheIdxPath = os.path.join(cachePath, 'INDEX')
-
-        if not os.path.exists(cachePath):
-            os.mkdir(cachePath)
-
-        try:    cacheIdx = tools.pickleLoad(cacheIdxPath)
-        except: cacheIdx = {}
-
-        nextInt   = len(cacheIdx) + 1
-        filename  = str(nextInt) + coverFormat
-        coverPath = os.path.join(cachePath, filename)
-
-        cacheIdx[artist + album] = filename
-        tools.pickleSave(cacheIdxPath, cacheIdx)
+        cacheKey  = self.getCacheKey(artist, album)
+        filename  = cacheKey + coverFormat
+        coverPath = os.path.join(self.cacheRootPath, filename)
 
         try:
             output = open(coverPath, 'wb')
             output.write(data)
             output.close()
-            return coverPath
         except:
             logger.error('[%s] Could not save the downloaded cover\n\n%s' % (MOD_NAME, traceback.format_exc()))
+            return None
+
+        self.cacheLock.acquire()
+
+        oldCover = self.cacheManifest.pop(cacheKey, None)
+        if oldCover is not None:
+            self.cacheSize -= oldCover[CACHE_SIZE]
+
+        self.cacheManifest[cacheKey] = (filename, len(data))
+        self.cacheSize              += len(data)
+        self.cacheModified           = True
+        self.shrinkCache()
+        self.saveCache()
+
+        self.cacheLock.release()
+
+        if os.path.exists(coverPath):
+            return coverPath
 
         return None
 
@@ -278,7 +470,11 @@ class Covers(modules.ThreadedModule):
         coverKey = artist + album
 
         # If we already tried without success, don't try again
-        if coverKey in self.coverBlacklist:
+        self.cacheLock.acquire()
+        isBlacklisted = coverKey in self.coverBlacklist
+        self.cacheLock.release()
+
+        if isBlacklisted:
             return None
 
         # Otherwise, try to download the cover
@@ -286,11 +482,56 @@ class Covers(modules.ThreadedModule):
 
         # If the download failed, blacklist the album
         if cover is None:
+            self.cacheLock.acquire()
             self.coverBlacklist[coverKey] = None
+            self.cacheLock.release()
 
         return cover
 
 
+    def getLocalCover(self, track, artist, album):
+        """ Return the path to the user cover or to the cached cover of the given track, or None if there is none """
+        rawCover = None
+
+        # Should we check for a user cover?
+        if not prefs.get(__name__, 'download-covers', PREFS_DFT_DOWNLOAD_COVERS)        \
+            or prefs.get(__name__, 'prefer-user-covers', PREFS_DFT_PREFER_USER_COVERS):
+                rawCover = self.getUserCover(os.path.dirname(track.getFilePath()))
+
+        # Is it in our cache?
+        if rawCover is None:
+            rawCover = self.getFromCache(artist, album)
+
+        return rawCover
+
+
+    def onUpcomingTracks(self, tracks):
+        """
+            Prepare the covers of the tracks that are going to be played next, so that they are ready when needed
+            Only local covers are looked up here, downloads are left to the workers so that the current track is never delayed
+        """
+        for track in tracks:
+            if track.getArtist() == consts.UNKNOWN_ARTIST or track.getAlbum() == consts.UNKNOWN_ALBUM:
+                continue
+
+            album    = track.getAlbum().lower()
+            artist   = track.getArtist().lower()
+            coverKey = artist + album
+
+            self.coverLock.acquire()
+            isKnown = coverKey in self.coverMap
+            self.coverLock.release()
+
+            if isKnown:
+                continue
+
+            rawCover = self.getLocalCover(track, artist, album)
+
+            # Workers give a higher priority to the current track
+            if rawCover is not None or prefs.get(__name__, 'download-covers', PREFS_DFT_DOWNLOAD_COVERS):
+                self.__addImgJob(IMG_PRIO_PREFETCH, track, coverKey, rawCover, self.prefetchId)
+
+
     def onNewTrack(self, track):
         """ A new track is being played, try to retrieve the corresponding cover """
         # Make sure we have enough information
@@ -301,12 +542,14 @@ class Covers(modules.ThreadedModule):
         album          = track.getAlbum().lower()
         artist         = track.getArtist().lower()
         coverKey       = artist + album
-        rawCover       = None
         self.currTrack = track
 
         # Let's see whether we already have the cover
-        if coverKey in self.coverMap:
-            covers        = self.coverMap[coverKey]
+        self.coverLock.acquire()
+        covers = self.coverMap.get(coverKey, None)
+        self.coverLock.release()
+
+        if covers is not None:
             pathFullSize  = covers[CVR_FULL]
             pathThumbnail = covers[CVR_THUMB]
 
@@ -315,14 +558,8 @@ class Covers(modules.ThreadedModule):
                 modules.postMsg(consts.MSG_CMD_SET_COVER, {'track': track, 'pathThumbnail': pathThumbnail, 'pathFullSize': pathFullSize})
                 return
 
-        # Should we check for a user cover?
-        if not prefs.get(__name__, 'download-covers', PREFS_DFT_DOWNLOAD_COVERS)        \
-            or prefs.get(__name__, 'prefer-user-covers', PREFS_DFT_PREFER_USER_COVERS):
-                rawCover = self.getUserCover(os.path.dirname(track.getFilePath()))
-
-        # Is it in our cache?
-        if rawCover is None:
-            rawCover = self.getFromCache(artist, album)
+        # Is there a user cover or a cached one?
+        rawCover = self.getLocalCover(track, artist, album)
 
         # If we still don't have a cover, maybe we can try to download it
         if rawCover is None:
@@ -332,17 +569,9 @@ class Covers(modules.ThreadedModule):
                 rawCover = self.getFromInternet(artist, album)
 
         # If we still don't have a cover, too bad
-        # Otherwise, generate a thumbnail and a full size cover, and add it to our cover map
+        # Otherwise, the workers generate a thumbnail and a full size cover, and add it to our cover map
         if rawCover is not None:
-            thumbnail     = tempfile.mktemp() + '.png'
-            fullSizeCover = tempfile.mktemp() + '.png'
-            self.generateThumbnail(rawCover, thumbnail, 'PNG')
-            self.generateFullSizeCover(rawCover, fullSizeCover, 'PNG')
-            if os.path.exists(thumbnail) and os.path.exists(fullSizeCover):
-                self.coverMap[coverKey] = (thumbnail, fullSizeCover)
-                modules.postMsg(consts.MSG_CMD_SET_COVER, {'track': track, 'pathThumbnail': thumbnail, 'pathFullSize': fullSizeCover})
-            else:
-                modules.postMsg(consts.MSG_CMD_SET_COVER, {'track': track, 'pathThumbnail': None, 'pathFullSize': None})
+            self.__addImgJob(IMG_PRIO_CURRENT, track, coverKey, rawCover, self.prefetchId)
 
 
     # --== Message handler ==--
@@ -351,7 +580,11 @@ class Covers(modules.ThreadedModule):
     def handleMsg(self, msg, params):
         """ Handle messages sent to this module """
         if msg == consts.MSG_EVT_NEW_TRACK:
+            self.prefetchId += 1
             self.onNewTrack(params['track'])
+        elif msg == consts.MSG_EVT_UPCOMING_TRACKS:
+            self.prefetchId += 1
+            self.onUpcomingTracks(params['tracks'])
         elif msg in (consts.MSG_EVT_MOD_LOADED, consts.MSG_EVT_APP_STARTED):
             self.onModLoaded()
         elif msg in (consts.MSG_EVT_MOD_UNLOADED, consts.MSG_EVT_APP_QUIT):
@@ -25,6 +25,9 @@ MOD_INFO = ('Control Panel', 'Control Panel', '', [], True, False)
 
 PREFS_DEFAULT_VOLUME = 0.65
 
+# Number of milliseconds between two updates of the position, when the window is visible
+POSITION_INTERVAL = 250
+
 
 class CtrlPanel(modules.Module):
     """ This module manages the control panel with the buttons and the slider """
@@ -33,14 +36,15 @@ class CtrlPanel(modules.Module):
         """ Constructor """
         modules.Module.__init__(self, (consts.MSG_EVT_STOPPED,        consts.MSG_EVT_PAUSED,      consts.MSG_EVT_UNPAUSED,
                                        consts.MSG_EVT_TRACK_MOVED,    consts.MSG_EVT_NEW_TRACK,   consts.MSG_EVT_NEW_TRACKLIST,
-                                       consts.MSG_EVT_TRACK_POSITION, consts.MSG_EVT_APP_STARTED, consts.MSG_EVT_APP_QUIT,
-                                       consts.MSG_EVT_VOLUME_CHANGED))
+                                       consts.MSG_EVT_VOLUME_CHANGED, consts.MSG_EVT_APP_STARTED, consts.MSG_EVT_APP_QUIT,
+                                       consts.MSG_EVT_MOD_UNLOADED))
 
 
     def onAppStarted(self):
         """ Real initialization function, called when this module has been loaded """
         self.currTrackLength = 0
         self.sclBeingDragged = False
+        self.posSubscribed   = False
         # Widgets
         wTree             = prefs.getWidgetsTree()
 #        self.btnStop      = wTree.get_widget('btn-stop')
@@ -51,6 +55,7 @@ class CtrlPanel(modules.Module):
         self.btnVolume    = wTree.get_widget('btn-volume')
         self.lblElapsed   = wTree.get_widget('lbl-elapsedTime')
         self.lblRemaining = wTree.get_widget('lbl-remainingTime')
+        self.window       = wTree.get_widget('win-main')
 
         # Initial state
         self.onStopped()
@@ -68,6 +73,27 @@ class CtrlPanel(modules.Module):
         volumeValue = prefs.get(__name__, 'volume', PREFS_DEFAULT_VOLUME)
         if self.btnVolume.get_value() != volumeValue: self.btnVolume.set_value(volumeValue)
         else:                                         self.onVolumeValueChanged(self.btnVolume, volumeValue)
+        # The position is not needed when nobody can see it (e.g., the window is minimized)
+        self.windowHandlers = (self.window.connect('map-event',          lambda win, evt: self.subscribePosition(True)),
+                               self.window.connect('unmap-event',        lambda win, evt: self.subscribePosition(False)),
+                               self.window.connect('window-state-event', self.onWindowStateChanged))
+        self.subscribePosition(self.window.get_property('visible'))
+
+
+    def onModUnloaded(self):
+        """ The module has been unloaded, the player must not keep sending the position to it """
+        for handler in self.windowHandlers:
+            self.window.disconnect(handler)
+        self.subscribePosition(False)
+
+
+    def subscribePosition(self, subscribe):
+        """ Ask the player to send the position of the current track, or to stop sending it """
+        if subscribe != self.posSubscribed:
+            self.posSubscribed = subscribe
+
+            if subscribe: modules.postMsg(consts.MSG_CMD_SUBSCRIBE_POS, {'module': self, 'interval': POSITION_INTERVAL})
+            else:         modules.postMsg(consts.MSG_CMD_SUBSCRIBE_POS, {'module': self, 'interval': 0})
 
 
     def onNewTrack(self, track):
@@ -161,6 +187,11 @@ class CtrlPanel(modules.Module):
         modules.postMsg(consts.MSG_CMD_SET_VOLUME, {'value': value})
 
 
+    def onWindowStateChanged(self, window, event):
+        """ The window has been minimized or restored """
+        self.subscribePosition(not (event.new_window_state & (gtk.gdk.WINDOW_STATE_ICONIFIED | gtk.gdk.WINDOW_STATE_WITHDRAWN)))
+
+
    # --== Message handler ==--
 
 
@@ -176,3 +207,4 @@ class CtrlPanel(modules.Module):
         elif msg == consts.MSG_EVT_TRACK_MOVED:    self.onTrackMoved(params['hasPrevious'], params['hasNext'])
         elif msg == consts.MSG_EVT_NEW_TRACKLIST:  self.btnPlay.set_sensitive(len(params['tracks']) != 0)
         elif msg == consts.MSG_EVT_VOLUME_CHANGED: self.onVolumeChanged(params['value'])
+        elif msg == consts.MSG_EVT_MOD_UNLOADED:   self.onModUnloaded()
@@ -60,7 +60,7 @@ class DBusInterface(dbus.service.Object):
                    consts.MSG_CMD_TRACKLIST_CLR, consts.MSG_CMD_TRACKLIST_SHUFFLE):
             gobject.idle_add(modules.postMsg, msg)
         elif msg == consts.MSG_CMD_TRACKLIST_ADD:
-            gobject.idle_add(modules.postMsg, msg, {'tracks': media.getTracks([file for file in params])})
+            gobject.idle_add(modules.postMsg, msg, {'stream': media.iterTracks([file for file in params])})
         elif msg == consts.MSG_CMD_TRACKLIST_SET:
             gobject.idle_add(modules.postMsg, msg, {'tracks': media.getTracks([file for file in params]), 'playNow': True})
         elif msg == consts.MSG_CMD_SET_VOLUME:
@@ -42,7 +42,7 @@ class Equalizer(modules.Module):
 
 
     def onAppStarted(self):
-        """ The module has been loaded """
+        """ The module has been loaded, add the equalizer to the audio chain """
         self.onModLoaded()
         modules.postMsg(consts.MSG_CMD_ENABLE_EQZ)
         modules.postMsg(consts.MSG_CMD_SET_EQZ_LVLS, {'lvls': self.lvls})
@@ -56,10 +56,9 @@ class Equalizer(modules.Module):
         if msg == consts.MSG_EVT_APP_STARTED:
             self.onAppStarted()
         elif msg == consts.MSG_EVT_MOD_LOADED:
-            self.onModLoaded()
-            gui.infoMsgBox(None, _('Restart required'), _('You must restart the application for this modification to take effect.'))
+            self.onAppStarted()
         elif msg == consts.MSG_EVT_MOD_UNLOADED:
-            gui.infoMsgBox(None, _('Restart required'), _('You must restart the application for this modification to take effect.'))
+            modules.postMsg(consts.MSG_CMD_DISABLE_EQZ)
 
 
     # --== Configuration ==--
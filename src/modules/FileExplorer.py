@@ -22,7 +22,6 @@ from gui     import fileChooser, help, extTreeview, extListview, selectPath
 from tools   import consts, prefs
 from media   import playlist
 from gettext import gettext as _
-from os.path import isdir, isfile
 from gobject import idle_add, TYPE_STRING, TYPE_INT
 
 MOD_INFO = ('File Explorer', _('File Explorer'), _('Browse your file system'), [], True, True)
@@ -197,14 +196,14 @@ class FileExplorer(modules.Module):
         mediaFiles  = []
         directories = []
 
-        for (file, path) in tools.listDir(directory, self.showHiddenFiles):
-            if isdir(path):
-                directories.append((consts.icoDir, cgi.escape(unicode(file, errors='replace')), TYPE_DIR, path))
-            elif isfile(path):
-                if media.isSupported(file):
-                    mediaFiles.append((consts.icoMediaFile, cgi.escape(unicode(file, errors='replace')), TYPE_FILE, path))
-                elif playlist.isSupported(file):
-                    playlists.append((consts.icoMediaFile, cgi.escape(unicode(file, errors='replace')), TYPE_FILE, path))
+        for entry in tools.listDir(directory, self.showHiddenFiles):
+            if entry.isDir:
+                directories.append((consts.icoDir, cgi.escape(unicode(entry.name, errors='replace')), TYPE_DIR, entry.path))
+            elif entry.isFile:
+                if media.isSupported(entry.name):
+                    mediaFiles.append((consts.icoMediaFile, cgi.escape(unicode(entry.name, errors='replace')), TYPE_FILE, entry.path))
+                elif playlist.isSupported(entry.name):
+                    playlists.append((consts.icoMediaFile, cgi.escape(unicode(entry.name, errors='replace')), TYPE_FILE, entry.path))
 
         playlists.sort(key=self.sortKey)
         mediaFiles.sort(key=self.sortKey)
@@ -241,8 +240,8 @@ class FileExplorer(modules.Module):
             directory  = self.tree.getItem(child, ROW_FULLPATH)
             hasContent = False
             if os.access(directory, os.R_OK | os.X_OK):
-                for (file, path) in tools.listDir(directory, self.showHiddenFiles):
-                    if isdir(path) or (isfile(path) and (media.isSupported(file) or playlist.isSupported(file))):
+                for entry in tools.listDir(directory, self.showHiddenFiles):
+                    if entry.isDir or (entry.isFile and (media.isSupported(entry.name) or playlist.isSupported(entry.name))):
                         hasContent = True
                         break
 
@@ -263,6 +262,9 @@ class FileExplorer(modules.Module):
         if treePath is None: directory = self.folders[self.currRoot]
         else:                directory = self.tree.getItem(treePath, ROW_FULLPATH)
 
+        # Don't trust the cache, the modification time of the directory may not have changed yet
+        tools.invalidateDirCache(directory)
+
         directories, playlists, mediaFiles = self.getDirContents(directory)
 
         disk                   = directories + playlists + mediaFiles
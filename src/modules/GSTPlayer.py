@@ -18,13 +18,11 @@
 
 import gobject, modules, os.path
 
-from time  import time
 from tools import consts, prefs
 from media import audioplayer
 
 
-MOD_INFO           = ('GStreamer Player', 'GStreamer Player', '', [], True, False)
-MIN_PLAYBACK_DELAY = 1.5
+MOD_INFO = ('GStreamer Player', 'GStreamer Player', '', [], True, False)
 
 
 class GSTPlayer(modules.Module):
@@ -35,92 +33,92 @@ class GSTPlayer(modules.Module):
         modules.Module.__init__(self, (consts.MSG_CMD_PLAY,   consts.MSG_CMD_SET_VOLUME,   consts.MSG_CMD_ENABLE_RG,
                                        consts.MSG_CMD_SEEK,   consts.MSG_EVT_APP_STARTED,  consts.MSG_CMD_DISABLE_RG,
                                        consts.MSG_CMD_STOP,   consts.MSG_CMD_TOGGLE_PAUSE, consts.MSG_CMD_ENABLE_EQZ,
-                                       consts.MSG_CMD_BUFFER, consts.MSG_CMD_SET_EQZ_LVLS))
+                                       consts.MSG_CMD_BUFFER, consts.MSG_CMD_SET_EQZ_LVLS,  consts.MSG_CMD_SUBSCRIBE_POS,
+                                       consts.MSG_CMD_DISABLE_EQZ))
 
     def onAppStarted(self):
         """ This is the real initialization function, called when this module has been loaded """
-        self.player        = audioplayer.AudioPlayer(self.__onTrackEnded, prefs.getCmdLine()[0].playbin2)
+        options            = prefs.getCmdLine()[0]
+        self.player        = audioplayer.AudioPlayer(self.__onTrackEnded, options.playbin2, self.__onNeedNextTrack, options.preroll, options.crossfade)
         self.nextURI       = None
         self.queuedSeek    = None
+        self.updateTick    = 0
         self.updateTimer   = None
-        self.lastPlayback  = 0
-        self.playbackTimer = None
+        self.subscribers   = {}     # Modules that want to receive the current position, associated to their update interval
 
 
     def updateTimerHandler(self):
-        """ Regularly called during playback (can be paused) """
-        if self.player.isPlaying():
-            position  = self.player.getPosition()
-            remaining = self.player.getDuration() - position
-
-            modules.postMsg(consts.MSG_EVT_TRACK_POSITION, {'seconds': int(position / 1000000000)})
+        """ Regularly called during playback, send the current position to the subscribers that need it """
+        self.updateTick += 1
+        interval         = min(self.subscribers.itervalues())
+        params           = None
 
-            if remaining < 4000000000 and self.nextURI is None:
-                modules.postMsg(consts.MSG_EVT_NEED_BUFFER)
+        for module, modInterval in self.subscribers.iteritems():
+            if self.updateTick % max(1, modInterval / interval) == 0:
+                if params is None:
+                    params = {'seconds': int(self.player.getPosition() / 1000000000)}
+                module.postMsg(consts.MSG_EVT_TRACK_POSITION, params)
 
         return True
 
 
     def __startUpdateTimer(self):
-        """ Start the update timer if needed """
-        if self.updateTimer is None:
-            self.updateTimer = gobject.timeout_add(1000, self.updateTimerHandler)
+        """ Start the update timer if needed, the timer runs at the pace of the most demanding subscriber """
+        if self.updateTimer is None and len(self.subscribers) != 0:
+            self.updateTick  = 0
+            self.updateTimer = gobject.timeout_add(min(self.subscribers.itervalues()), self.updateTimerHandler)
 
 
     def __stopUpdateTimer(self):
-        """ Start the update timer if needed """
+        """ Stop the update timer if it is running """
         if self.updateTimer is not None:
             gobject.source_remove(self.updateTimer)
             self.updateTimer = None
 
 
+    def subscribePosition(self, module, interval):
+        """ Send the current position to the given module every interval milliseconds during playback, or no longer if interval is 0 (subscribers must do so when unloaded) """
+        if interval > 0:                  self.subscribers[module] = interval
+        elif module in self.subscribers: del self.subscribers[module]
+
+        self.__stopUpdateTimer()
+        if self.player.isPlaying():
+            self.__startUpdateTimer()
+
+
     def bufferNextTrack(self, uri):
         """ Buffer the next track """
-        if self.nextURI is None and prefs.getCmdLine()[0].playbin2:
+        if self.nextURI is None:
             self.nextURI = uri
             self.player.setNextURI(uri)
 
 
+    def __onNeedNextTrack(self):
+        """ Called when the current track is close to its end, so that the next one can be prepared in advance """
+        if self.nextURI is None:
+            modules.postMsg(consts.MSG_EVT_NEED_BUFFER)
+
+
     def __onTrackEnded(self, error):
         """ Called to signal eos and errors """
         self.__stopUpdateTimer()
 
+        # The player does not switch to the next track on errors
+        if error:
+            self.nextURI = None
+            self.player.clearNextURI()
+
         if error: modules.postMsg(consts.MSG_EVT_TRACK_ENDED_ERROR)
         else:     modules.postMsg(consts.MSG_EVT_TRACK_ENDED_OK)
 
 
-    def __playbackTimerHandler(self):
-        """ Switch the player to playback mode, and start the update timer """
-        if not self.player.isPlaying():
-            self.player.play()
-
-        self.nextURI       = None
-        self.lastPlayback  = time()
-        self.playbackTimer = None
-
-        self.__startUpdateTimer()
-
-        return False
-
-
     def play(self, uri):
-        """ Play the given URI """
-        if uri != self.nextURI:
-            self.player.stop()
-            self.player.setURI(uri)
-            self.__stopUpdateTimer()
-
-        elapsed = time() - self.lastPlayback
+        """ Play the given URI, the player takes care of requests that are too close to each other (e.g., when clicking "next" very fast) """
+        self.player.playURI(uri)
+        self.nextURI = None
 
-        # Looks like GStreamer can be pretty much fucked if we start/stop the pipeline too quickly (e.g., when clicking "next" very fast)
-        # We minimize the load in these extreme cases by ensuring that at least one second has elapsed since the last playback
-        # Note that this delay is avoided when tracks are chained, since the playback of the next track has then already started (uri == self.nextURI)
-        if elapsed >= MIN_PLAYBACK_DELAY:
-            self.__playbackTimerHandler()
-        else:
-            if self.playbackTimer is not None:
-                gobject.source_remove(self.playbackTimer)
-            self.playbackTimer = gobject.timeout_add(int((MIN_PLAYBACK_DELAY - elapsed) * 1000), self.__playbackTimerHandler)
+        self.__stopUpdateTimer()
+        self.__startUpdateTimer()
 
 
     def stop(self):
@@ -130,9 +128,6 @@ class GSTPlayer(modules.Module):
         self.nextURI = None
         self.player.clearNextURI()
 
-        if self.playbackTimer is not None:
-            gobject.source_remove(self.playbackTimer)
-
         modules.postMsg(consts.MSG_EVT_STOPPED)
 
 
@@ -143,13 +138,11 @@ class GSTPlayer(modules.Module):
                 self.player.seek(self.queuedSeek*1000000000)
                 self.queuedSeek = None
             self.player.play()
+            self.__startUpdateTimer()
             modules.postMsg(consts.MSG_EVT_UNPAUSED)
         elif self.player.isPlaying():
-
-            if self.playbackTimer is not None:
-                gobject.source_remove(self.playbackTimer)
-
             self.player.pause()
+            self.__stopUpdateTimer()
             modules.postMsg(consts.MSG_EVT_PAUSED)
 
 
@@ -170,14 +163,16 @@ class GSTPlayer(modules.Module):
 
     def handleMsg(self, msg, params):
         """ Handle messages sent to this module """
-        if   msg == consts.MSG_CMD_STOP:         self.stop()
-        elif msg == consts.MSG_CMD_PLAY:         self.play(params['uri'])
-        elif msg == consts.MSG_CMD_SEEK:         self.seek(params['seconds'])
-        elif msg == consts.MSG_CMD_BUFFER:       self.bufferNextTrack(params['uri'])
-        elif msg == consts.MSG_CMD_ENABLE_RG:    self.player.enableReplayGain()
-        elif msg == consts.MSG_CMD_DISABLE_RG:   self.player.disableReplayGain()
-        elif msg == consts.MSG_CMD_SET_VOLUME:   self.setVolume(params['value'])
-        elif msg == consts.MSG_EVT_APP_STARTED:  self.onAppStarted()
-        elif msg == consts.MSG_CMD_ENABLE_EQZ:   self.player.enableEqualizer()
-        elif msg == consts.MSG_CMD_SET_EQZ_LVLS: self.player.setEqualizerLvls(params['lvls'])
-        elif msg == consts.MSG_CMD_TOGGLE_PAUSE: self.togglePause()
+        if   msg == consts.MSG_CMD_STOP:          self.stop()
+        elif msg == consts.MSG_CMD_PLAY:          self.play(params['uri'])
+        elif msg == consts.MSG_CMD_SEEK:          self.seek(params['seconds'])
+        elif msg == consts.MSG_CMD_BUFFER:        self.bufferNextTrack(params['uri'])
+        elif msg == consts.MSG_CMD_ENABLE_RG:     self.player.enableReplayGain()
+        elif msg == consts.MSG_CMD_DISABLE_RG:    self.player.disableReplayGain()
+        elif msg == consts.MSG_CMD_SET_VOLUME:    self.setVolume(params['value'])
+        elif msg == consts.MSG_EVT_APP_STARTED:   self.onAppStarted()
+        elif msg == consts.MSG_CMD_ENABLE_EQZ:    self.player.enableEqualizer()
+        elif msg == consts.MSG_CMD_DISABLE_EQZ:   self.player.disableEqualizer()
+        elif msg == consts.MSG_CMD_SET_EQZ_LVLS:  self.player.setEqualizerLvls(params['lvls'])
+        elif msg == consts.MSG_CMD_TOGGLE_PAUSE:  self.togglePause()
+        elif msg == consts.MSG_CMD_SUBSCRIBE_POS: self.subscribePosition(params['module'], params['interval'])
@@ -16,13 +16,14 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import cgi, collections, gtk, gui, media, modules, os, random, shutil, sys, tools
+import cgi, errno, gtk, gui, media, modules, os, Queue, random, shutil, sqlite3, sys, threading, tools, traceback
 
 from gui                   import fileChooser, help, questionMsgBox, extTreeview, extListview, progressDlg, selectPath
-from tools                 import consts, prefs, pickleLoad, pickleSave
+from tools                 import consts, prefs
+from tools.dirWatcher      import DirWatcher
 from gettext               import ngettext, gettext as _
 from os.path               import isdir, isfile
-from gobject               import idle_add, TYPE_STRING, TYPE_INT, TYPE_PYOBJECT
+from gobject               import idle_add, timeout_add, TYPE_STRING, TYPE_INT, TYPE_PYOBJECT
 from tools.log             import logger
 from gui.progressDlg       import ProgressDlg
 from media.track.fileTrack import FileTrack
@@ -33,11 +34,16 @@ MOD_NAME = MOD_INFO[modules.MODINFO_NAME]
 
 
 # Constants
-VERSION                  = 2                                      # Used to enforce compatibility
+VERSION                  = 4                                      # Used to enforce compatibility
 ROOT_PATH                = os.path.join(consts.dirCfg, 'Library') # Path where libraries are stored
+DB_FILENAME              = 'library.db'                           # Name of the database, within the directory of each library
 PREFS_DEFAULT_PREFIXES   = {'the ': None}                         # Prefixes are put at the end of artists' names
 PREFS_DEFAULT_LIBRARIES  = {}                                     # No libraries at first
 PREFS_DEFAULT_TREE_STATE = {}                                     # No state at first
+PREFS_DEFAULT_WATCH      = True                                   # Record changes to the libraries, so that a refresh only applies them
+SCAN_NB_WORKERS          = 8                                      # Number of threads exploring directories (mostly waiting for I/O)
+SCAN_POLL_INTERVAL       = 50                                     # Milliseconds between two checks of a background scan by the GTK main loop
+SCAN_WAIT                = -1                                     # Yielded by the refresh generators to be resumed after SCAN_POLL_INTERVAL
 
 
 # Information associated with libraries
@@ -49,23 +55,50 @@ PREFS_DEFAULT_TREE_STATE = {}                                     # No state at
 ) = range(4)
 
 
-# Information associated with artists
+# Information associated with artists (order of the columns selected from the database)
 (
     ART_NAME,       # Its name
-    ART_INDEX,      # Name of the directory: avoid the use of the artist name as a filename (may contain invalid characters)
+    ART_INDEX,      # Its identifier in the database
     ART_NB_ALBUMS   # How many albums
 ) = range(3)
 
 
-# Information associated with albums
+# Information associated with albums (order of the columns selected from the database)
 (
     ALB_NAME,       # Its name
-    ALB_INDEX,      # Name of the file: avoid the use of the artist name as a filename (may contain invalid characters)
+    ALB_INDEX,      # Its identifier in the database
     ALB_NB_TRACKS,  # Number of tracks
     ALB_LENGTH      # Complete duration (include all tracks)
 ) = range(4)
 
 
+# Structure of the database of a library
+DB_SCHEMA = (
+    'CREATE TABLE artists     (id INTEGER PRIMARY KEY, name TEXT, nbAlbums INTEGER)',
+    'CREATE TABLE albums      (id INTEGER PRIMARY KEY, artist INTEGER, name TEXT, album TEXT, disc INTEGER, nbTracks INTEGER, length INTEGER)',
+    'CREATE TABLE tracks      (id INTEGER PRIMARY KEY, album INTEGER, directory TEXT, filename TEXT, mtime REAL, number INTEGER, tags TEXT)',
+    'CREATE TABLE directories (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)',
+    'CREATE INDEX albumsByArtist    ON albums (artist)',
+    'CREATE INDEX tracksByAlbum     ON tracks (album)',
+    'CREATE INDEX tracksByDirectory ON tracks (directory)',
+    'PRAGMA user_version = %u' % VERSION,
+)
+
+# Queries used to populate the tree
+# The name of an album includes its disc number, so albums are sorted on their bare name and on their disc number (as a number)
+DB_SELECT_ARTISTS       = 'SELECT name, id, nbAlbums FROM artists ORDER BY name'
+DB_SELECT_ALBUMS        = 'SELECT name, id, nbTracks, length FROM albums WHERE artist = ? ORDER BY lower(album), disc, id'
+DB_SELECT_ALBUM_TRACKS  = 'SELECT tags FROM tracks WHERE album = ? ORDER BY number, id'
+DB_SELECT_ARTIST_TRACKS = 'SELECT tracks.tags FROM tracks, albums WHERE tracks.album = albums.id AND albums.artist = ? ' \
+                          'ORDER BY lower(albums.album), albums.disc, albums.id, tracks.number, tracks.id'
+
+# Queries used to update a library
+DB_INSERT_ALBUM         = 'INSERT INTO albums (artist, name, album, disc, nbTracks, length) VALUES (?, ?, ?, ?, ?, ?)'
+DB_SELECT_TRACK         = 'SELECT id, album, mtime, tags FROM tracks WHERE directory = ? AND filename = ?'
+DB_SELECT_TREE_TRACKS   = 'SELECT id, album, mtime, tags FROM tracks WHERE directory = ? OR (directory >= ? AND directory < ?)'
+DB_DELETE_TREE          = 'DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)'
+
+
 # Possible types for a node of the tree
 (
     TYPE_ARTIST,    # Artist
@@ -101,8 +134,13 @@ class Library(modules.Module):
         self.tree      = None
         self.currLib   = None
         self.cfgWindow = None
+        self.watchers  = {}
+        self.databases = {}
         self.libraries = prefs.get(__name__, 'libraries',  PREFS_DEFAULT_LIBRARIES)
         self.treeState = prefs.get(__name__, 'tree-state', PREFS_DEFAULT_TREE_STATE)
+        # Watch the libraries for changes
+        for (name, (path, nbArtists, nbAlbums, nbTracks)) in self.libraries.iteritems():
+            self.__startWatcher(name, path)
         # Scroll window
         self.scrolled = gtk.ScrolledWindow()
         self.scrolled.set_shadow_type(gtk.SHADOW_IN)
@@ -171,21 +209,327 @@ class Library(modules.Module):
         else:                                            cell.set_property('visible', True)
 
 
+    def __getDatabase(self, name):
+        """ Return the connection to the database of the given library, open it if needed """
+        if name not in self.databases:
+            connection = sqlite3.connect(os.path.join(ROOT_PATH, name, DB_FILENAME))
+            # Tags are stored as they are given by the tracks, which are not Unicode strings
+            connection.text_factory = str
+            self.databases[name] = connection
+
+        return self.databases[name]
+
+
+    def __closeDatabase(self, name):
+        """ Close the connection to the database of the given library, if any """
+        if name in self.databases:
+            self.databases[name].close()
+            del self.databases[name]
+
+
+    def __startWatcher(self, name, path):
+        """ Start recording the changes made to the given library, if needed """
+        if name not in self.watchers and prefs.get(__name__, 'watch-libraries', PREFS_DEFAULT_WATCH):
+            self.watchers[name] = DirWatcher(path)
+            self.watchers[name].start()
+
+
+    def __stopWatcher(self, name):
+        """ Stop recording the changes made to the given library, if needed """
+        if name in self.watchers:
+            self.watchers[name].stop()
+            del self.watchers[name]
+
+
+    def __isUpToDate(self, name):
+        """ Return True if the given library exists and has been created with the current version """
+        if not isfile(os.path.join(ROOT_PATH, name, DB_FILENAME)):
+            return False
+
+        try:    return self.__getDatabase(name).execute('PRAGMA user_version').fetchone()[0] == VERSION
+        except: return False
+
+
     def __createEmptyLibrary(self, name):
         """ Create bootstrap files for a new library """
         # Make sure that the root directory of all libraries exists
         if not isdir(ROOT_PATH):
             os.mkdir(ROOT_PATH)
         # Start from an empty library
+        self.__closeDatabase(name)
         libPath = os.path.join(ROOT_PATH, name)
         if isdir(libPath):
             shutil.rmtree(libPath)
         os.mkdir(libPath)
-        pickleSave(os.path.join(libPath, 'files'), {})
+        connection = self.__getDatabase(name)
+        for statement in DB_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+
+    def __loadFileStructure(self, connection):
+        """ Return the file structure of the library stored in the given database, that is a dictionary directory -> (mTime, subdirectories, files) """
+        library = {}
+
+        for (path, parent, mTime) in connection.execute('SELECT path, parent, mtime FROM directories'):
+            library[path] = (mTime, [], {})
+
+        for (path, parent, mTime) in connection.execute('SELECT path, parent, mtime FROM directories WHERE parent IS NOT NULL'):
+            if parent in library:
+                library[parent][1].append(path)
+
+        for (directory, filename, mTime, tags) in connection.execute('SELECT directory, filename, mtime, tags FROM tracks'):
+            if directory in library:
+                library[directory][2][filename] = [mTime, media.track.unserialize(tags)]
+
+        return library
+
+
+    def __getArtistName(self, track, prefixes):
+        """ Return the name of the artist under which the given track is stored """
+        if track.hasAlbumArtist(): artist = track.getAlbumArtist()
+        else:                      artist = track.getArtist()
+
+        # If an artist name begins with a known prefix, put it at the end (e.g., Future Sound of London (The))
+        artistLower = artist.lower()
+        for prefix in prefixes:
+            if artistLower.startswith(prefix):
+                return artist[len(prefix):] + ' (%s)' % artist[:len(prefix)-1]
+
+        return artist
+
+
+    def __removeTrackRows(self, connection, rows):
+        """ Remove the given rows (id, album, mtime, tags) from the table of tracks, and update their albums accordingly """
+        for (id, album, mTime, tags) in rows:
+            connection.execute('DELETE FROM tracks WHERE id = ?', (id,))
+            connection.execute('UPDATE albums SET nbTracks = nbTracks - 1, length = length - ? WHERE id = ?', (media.track.unserialize(tags).getLength(), album))
+
+
+    def __addTrack(self, connection, track, mTime, prefixes):
+        """ Insert the given track, create its artist and/or its album if needed """
+        artist = self.__getArtistName(track, prefixes)
+        album  = track.getExtendedAlbum()
+
+        row = connection.execute('SELECT id FROM artists WHERE name = ?', (artist,)).fetchone()
+        if row is None: artistId = connection.execute('INSERT INTO artists (name, nbAlbums) VALUES (?, 0)', (artist,)).lastrowid
+        else:           artistId = row[0]
+
+        row = connection.execute('SELECT id FROM albums WHERE artist = ? AND name = ?', (artistId, album)).fetchone()
+        if row is None: albumId = connection.execute(DB_INSERT_ALBUM, (artistId, album, track.getAlbum(), track.getDiscNumber(), 0, 0)).lastrowid
+        else:           albumId = row[0]
+
+        connection.execute('INSERT INTO tracks (album, directory, filename, mtime, number, tags) VALUES (?, ?, ?, ?, ?, ?)',
+                           (albumId,) + os.path.split(track.getFilePath()) + (mTime, track.getNumber(), track.serialize()))
+        connection.execute('UPDATE albums SET nbTracks = nbTracks + 1, length = length + ? WHERE id = ?', (track.getLength(), albumId))
+
+
+    def __applyChanges(self, parent, libName, path, modified, deleted):
+        """ Apply to the given library the changes recorded by its watcher, must be called through __runGenerator() """
+        progress = ProgressDlg(parent, _('Refreshing library'), _('The modified media files are scanned. This can take some time.\nPlease wait.'))
+        progress.setCancellable(False)
+        yield True
+
+        connection = self.__getDatabase(libName)
+        prefixes   = prefs.get(__name__, 'prefixes', PREFS_DEFAULT_PREFIXES)
+
+        # Deleted paths may be either files or whole directories
+        # Paths are byte strings, so the subtree of a directory is selected with a range of bytes (substr() would count UTF-8 characters)
+        for deletedPath in deleted:
+            treeBounds = (deletedPath, deletedPath + os.sep, deletedPath + chr(ord(os.sep) + 1))
+            rows       = connection.execute(DB_SELECT_TRACK, os.path.split(deletedPath)).fetchall()
+            rows      += connection.execute(DB_SELECT_TREE_TRACKS, treeBounds).fetchall()
+
+            self.__removeTrackRows(connection, rows)
+            media.tagCache.remove([media.track.unserialize(tags).getFilePath() for (id, album, mTime, tags) in rows])
+            connection.execute(DB_DELETE_TREE, treeBounds)
+
+        # Modified paths may be either files or new directories, which must then be entirely explored
+        files       = []
+        directories = []
+        for modifiedPath in modified:
+            if isdir(modifiedPath):
+                for (directory, subdirs, filenames) in os.walk(modifiedPath):
+                    directories.append(directory)
+                    files.extend([os.path.join(directory, filename) for filename in filenames])
+            elif isfile(modifiedPath):
+                files.append(modifiedPath)
+
+        for directory in directories:
+            mTime = self.__getMTime(directory)
+            if mTime is not None:
+                connection.execute('INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)', (directory, os.path.dirname(directory), mTime))
+
+        for i, file in enumerate(files):
+            if not media.isSupported(file):
+                continue
+
+            mTime = self.__getMTime(file)
+            rows  = connection.execute(DB_SELECT_TRACK, os.path.split(file)).fetchall()
+
+            # The file may have been deleted since the change has been recorded
+            if mTime is None:
+                self.__removeTrackRows(connection, rows)
+                media.tagCache.remove([file])
+            elif len(rows) == 0 or rows[0][2] != mTime:
+                self.__removeTrackRows(connection, rows)
+                self.__addTrack(connection, media.getTrackFromFile(file), mTime, prefixes)
+
+            if i % 50 == 0:
+                progress.pulse(ngettext('Scanning modified files (one file)', 'Scanning modified files (%(nbfiles)u files)', len(files)) % {'nbfiles': len(files)})
+                yield True
+
+        # Remove empty albums and artists
+        connection.execute('DELETE FROM albums WHERE nbTracks <= 0')
+        connection.execute('UPDATE artists SET nbAlbums = (SELECT count(*) FROM albums WHERE albums.artist = artists.id)')
+        connection.execute('DELETE FROM artists WHERE nbAlbums = 0')
+
+        # The file structure is now up to date
+        for directory in set([os.path.dirname(file) for file in files] + [os.path.dirname(deletedPath) for deletedPath in deleted]):
+            if isdir(directory):
+                connection.execute('UPDATE directories SET mtime = ? WHERE path = ?', (os.stat(directory).st_mtime, directory))
+
+        connection.commit()
+        media.tagCache.save()
+
+        nbArtists = connection.execute('SELECT count(*) FROM artists').fetchone()[0]
+        nbAlbums  = connection.execute('SELECT count(*) FROM albums').fetchone()[0]
+        nbTracks  = connection.execute('SELECT count(*) FROM tracks').fetchone()[0]
+
+        self.libraries[libName] = (path, nbArtists, nbAlbums, nbTracks)
+        self.fillLibraryList()
+        progress.destroy()
+
+        # If the refreshed library is currently displayed, refresh the treeview as well
+        if self.currLib == libName:
+            treeState = self.tree.saveState(ROW_NAME)
+            self.loadLibrary(self.tree, self.currLib)
+            self.tree.restoreState(treeState, ROW_NAME)
+
+        yield False
+
+
+    def __getOldScans(self, directory, oldLibrary):
+        """ Return the list of tuples (directory, (mTime, subdirectories, files)) with the previous scan of the given directory and of its subdirectories """
+        scans   = []
+        pending = [directory]
+
+        while len(pending) != 0:
+            currDir = pending.pop()
+            if currDir in oldLibrary:
+                scans.append((currDir, oldLibrary[currDir]))
+                pending.extend(oldLibrary[currDir][1])
+
+        return scans
+
+
+    def __getMTime(self, path):
+        """ Return the modification time of the given path, or None if it does not exist anymore """
+        try:
+            return os.stat(path).st_mtime
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+
+
+    def __scanDirectories(self, jobs, results, oldLibrary, cancelled):
+        """
+            Thread body: scan the directories put in the jobs queue, until None is found
+            For each directory, the tuple (directory, (mTime, subdirectories, files)) is put in the results queue, (directory, None) on error
+            Subdirectories are then put in the jobs queue, so that the result of a directory always comes before the ones of its subdirectories
+        """
+        while True:
+            currDir = jobs.get(True)
+
+            if currDir is None:
+                break
+
+            if cancelled.isSet():
+                continue
+
+            try:
+                currDirMTime = os.stat(currDir).st_mtime
+
+                # Retrieve previous information on the current directory, if any
+                if currDir in oldLibrary: oldDirMTime, oldDirectories, oldFiles = oldLibrary[currDir]
+                else:                     oldDirMTime, oldDirectories, oldFiles = -1, [], {}
+
+                # If the directory has not been modified, keep old information
+                mTimes = {}
+                if currDirMTime == oldDirMTime:
+                    files, directories = oldFiles.copy(), oldDirectories
+                else:
+                    files, directories = {}, []
+                    for entry in tools.listDir(currDir, withStat=True):
+                        if entry.isDir:
+                            directories.append(entry.path)
+                        elif entry.isFile and media.isSupported(entry.name):
+                            if entry.name in oldFiles: files[entry.name] = oldFiles[entry.name]
+                            else:                      files[entry.name] = [-1, FileTrack(entry.path)]
+
+                            if entry.stat is not None:
+                                mTimes[entry.name] = entry.stat.st_mtime
+
+                # Determine which files need to be updated
+                for filename, (oldMTime, track) in files.items():
+                    if filename in mTimes: mTime = mTimes[filename]
+                    else:                  mTime = os.stat(track.getFilePath()).st_mtime
+
+                    if mTime != oldMTime:
+                        files[filename] = [mTime, media.getTrackFromFile(track.getFilePath())]
+            except:
+                logger.error('[%s] Unable to scan directory %s\n\n%s' % (MOD_NAME, currDir, traceback.format_exc()))
+                results.put((currDir, None))
+                continue
+
+            # The result must be collected before the ones of the subdirectories, otherwise the number of pending directories may drop to 0 too early
+            results.put((currDir, (currDirMTime, directories, files)))
+
+            for directory in directories:
+                jobs.put(directory)
+
+
+    def __runGenerator(self, generator):
+        """
+            Resume the given generator from the GTK main loop until it is done, must be called through idle_add()
+            The generator yields True to be resumed as soon as possible, SCAN_WAIT to be resumed after SCAN_POLL_INTERVAL, and False when it is done
+        """
+        try:
+            result = generator.next()
+        except StopIteration:
+            result = False
+
+        if result == SCAN_WAIT: timeout_add(SCAN_POLL_INTERVAL, self.__runGenerator, generator)
+        elif result:            idle_add(self.__runGenerator, generator)
+
+        return False
 
 
     def refreshLibrary(self, parent, libName, path, creation=False):
-        """ Refresh the given library, must be called through idle_add() """
+        """ Refresh the given library, must be called through __runGenerator() """
+        # If all changes made to the library since its last refresh are known, only apply them
+        if not creation and libName in self.watchers and self.__isUpToDate(libName):
+            watcher = self.watchers[libName]
+            scanId  = watcher.requestScan()
+
+            # When the tree is polled, the polling thread first looks for the most recent changes
+            if scanId is not None:
+                progress = ProgressDlg(parent, _('Refreshing library'), _('The directory is scanned for changes. This can take some time.\nPlease wait.'))
+                progress.setCancellable(False)
+
+                while not watcher.isScanDone(scanId):
+                    progress.pulse()
+                    yield SCAN_WAIT
+
+                progress.destroy()
+
+            changes = watcher.popChanges()
+            if changes is not None:
+                for result in self.__applyChanges(parent, libName, path, changes[0], changes[1]):
+                    yield result
+                return
+
         # First show a progress dialog
         if creation: header = _('Creating library')
         else:        header = _('Refreshing library')
@@ -196,60 +540,87 @@ class Library(modules.Module):
         libPath = os.path.join(ROOT_PATH, libName)   # Location of the library
 
         # If the version number has changed or does not exist, don't reuse any existing file and start from scratch
-        if not os.path.exists(os.path.join(libPath, 'VERSION_%u' % VERSION)):
+        if not self.__isUpToDate(libName):
             self.__createEmptyLibrary(libName)
 
+        # Changes made from now on will be recorded and applied by the next refresh (unless this one is cancelled)
+        self.__startWatcher(libName, path)
+        if libName in self.watchers:
+            self.watchers[libName].reset()
+
+        connection = self.__getDatabase(libName)                                       # Where the library is stored
         db         = {}                                                                # The dictionnary used to create the library
-        queue      = collections.deque((path,))                                        # Faster structure for appending/removing elements
+        jobs       = Queue.Queue()                                                     # Directories to be scanned by the workers
+        results    = Queue.Queue()                                                     # Directories scanned by the workers
+        nbPending  = 0                                                                 # Number of directories not scanned yet
+        cancelled  = threading.Event()                                                 # Tell the workers to stop as soon as possible
+        mTimes     = {}                                                                # Modification time of all media files found
         mediaFiles = []                                                                # All media files found
         newLibrary = {}                                                                # Reflect the current file structure of the library
-        oldLibrary = pickleLoad(os.path.join(libPath, 'files'))                        # Previous file structure of the same library
+        oldLibrary = self.__loadFileStructure(connection)                              # Previous file structure of the same library
 
         # Make sure the root directory still exists
-        if not os.path.exists(path):
-            queue.pop()
+        if os.path.exists(path):
+            jobs.put(path)
+            nbPending = 1
+
+        # Directories are explored by a pool of threads, the GTK main loop only collects the results
+        for i in xrange(SCAN_NB_WORKERS):
+            worker = threading.Thread(target=self.__scanDirectories, args=(jobs, results, oldLibrary, cancelled))
+            worker.setDaemon(True)
+            worker.start()
+
+        while nbPending != 0:
+            # Process all the directories scanned so far, the main loop is never blocked waiting for the workers
+            scanned = []
+            try:
+                while True:
+                    scanned.append(results.get_nowait())
+            except Queue.Empty:
+                pass
 
-        while len(queue) != 0:
-            currDir      = queue.pop()
-            currDirMTime = os.stat(currDir).st_mtime
+            for (currDir, scan) in scanned:
+                nbPending -= 1
 
-            # Retrieve previous information on the current directory, if any
-            if currDir in oldLibrary: oldDirMTime, oldDirectories, oldFiles = oldLibrary[currDir]
-            else:                     oldDirMTime, oldDirectories, oldFiles = -1, [], {}
+                # A directory may fail to be scanned because of a transient error, its previous content is then kept
+                if scan is None:
+                    scans = self.__getOldScans(currDir, oldLibrary)
+                else:
+                    scans      = [(currDir, scan)]
+                    nbPending += len(scan[1])
 
-            # If the directory has not been modified, keep old information
-            if currDirMTime == oldDirMTime:
-                files, directories = oldFiles, oldDirectories
-            else:
-                files, directories = {}, []
-                for (filename, fullPath) in tools.listDir(currDir):
-                    if isdir(fullPath):
-                        directories.append(fullPath)
-                    elif isfile(fullPath) and media.isSupported(filename):
-                        if filename in oldFiles: files[filename] = oldFiles[filename]
-                        else:                    files[filename] = [-1, FileTrack(fullPath)]
-
-            # Determine which files need to be updated
-            for filename, (oldMTime, track) in files.iteritems():
-                mTime = os.stat(track.getFilePath()).st_mtime
-                if mTime != oldMTime:
-                    files[filename] = [mTime, media.getTrackFromFile(track.getFilePath())]
-
-            newLibrary[currDir] = (currDirMTime, directories, files)
-            mediaFiles.extend([track for mTime, track in files.itervalues()])
-            queue.extend(directories)
-
-            # Update the progress dialog
+                for (directory, (currDirMTime, directories, files)) in scans:
+                    newLibrary[directory] = (currDirMTime, directories, files)
+                    mediaFiles.extend([track for mTime, track in files.itervalues()])
+
+                    for mTime, track in files.itervalues():
+                        mTimes[track.getFilePath()] = mTime
+
+            # Update the progress dialog, and give some time to the workers
             try:
                 text = ngettext('Scanning directories (one track found)', 'Scanning directories (%(nbtracks)u tracks found)', len(mediaFiles))
                 progress.pulse(text % {'nbtracks': len(mediaFiles)})
-                yield True
+                yield SCAN_WAIT
             except progressDlg.CancelledException:
+                cancelled.set()
+                for i in xrange(SCAN_NB_WORKERS):
+                    jobs.put(None)
                 progress.destroy()
                 if creation:
+                    self.__stopWatcher(libName)
+                    self.__closeDatabase(libName)
                     shutil.rmtree(libPath)
+                elif libName in self.watchers:
+                    # The library has not been updated, so the next refresh must be a complete one
+                    self.watchers[libName].invalidate()
                 yield False
 
+        # Stop the workers, the listing of the scanned directories is not needed anymore
+        for i in xrange(SCAN_NB_WORKERS):
+            jobs.put(None)
+
+        tools.invalidateDirCache(path, True)
+
         # From now on, the process should not be cancelled
         progress.setCancellable(False)
         if creation: progress.pulse(_('Creating library...'))
@@ -257,11 +628,10 @@ class Library(modules.Module):
         yield True
 
         # Create the database
+        prefixes = prefs.get(__name__, 'prefixes', PREFS_DEFAULT_PREFIXES)
         for track in mediaFiles:
-            album = track.getExtendedAlbum()
-
-            if track.hasAlbumArtist(): artist = track.getAlbumArtist()
-            else:                      artist = track.getArtist()
+            album  = track.getExtendedAlbum()
+            artist = self.__getArtistName(track, prefixes)
 
             if artist in db:
                 allAlbums = db[artist]
@@ -273,53 +643,84 @@ class Library(modules.Module):
         progress.pulse()
         yield True
 
-        # If an artist name begins with a known prefix, put it at the end (e.g., Future Sound of London (The))
-        prefixes = prefs.get(__name__, 'prefixes', PREFS_DEFAULT_PREFIXES)
-        for artist in db.keys():
-            artistLower = artist.lower()
-            for prefix in prefixes:
-                if artistLower.startswith(prefix):
-                    db[artist[len(prefix):] + ' (%s)' % artist[:len(prefix)-1]] = db[artist]
-                    del db[artist]
+        # Update the database, everything is done within a single transaction and only what has changed is written
+        storedDirs = {}
+        for (currDir, parent, currDirMTime) in connection.execute('SELECT path, parent, mtime FROM directories'):
+            storedDirs[currDir] = (parent, currDirMTime)
 
-        progress.pulse()
-        yield True
+        # The 'directories' table contains the file structure of the root path
+        parents = {}
+        for (currDir, (currDirMTime, directories, files)) in newLibrary.iteritems():
+            for directory in directories:
+                parents[directory] = currDir
 
-        # Re-create the library structure on the disk
-        if isdir(libPath):
-            shutil.rmtree(libPath)
-            os.mkdir(libPath)
+        for (currDir, (currDirMTime, directories, files)) in newLibrary.iteritems():
+            dirInfo = (parents.get(currDir, None), currDirMTime)
+            if storedDirs.pop(currDir, None) != dirInfo:
+                connection.execute('INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)', (currDir,) + dirInfo)
+
+        connection.executemany('DELETE FROM directories WHERE path = ?', [(currDir,) for currDir in storedDirs])
 
-        # Put a version number
-        tools.touch(os.path.join(libPath, 'VERSION_%u' % VERSION))
+        # An album has to be written again only if the set of its files or their modification time have changed
+        storedArtists = dict(connection.execute('SELECT name, id FROM artists'))
+        storedAlbums  = {}
+        storedFiles   = {}
+
+        for (albumId, artistId, name) in connection.execute('SELECT id, artist, name FROM albums'):
+            storedAlbums[(artistId, name)] = albumId
+            storedFiles[albumId]           = {}
+
+        for (albumId, directory, filename, mTime) in connection.execute('SELECT album, directory, filename, mtime FROM tracks'):
+            storedFiles[albumId][os.path.join(directory, filename)] = mTime
 
         overallNbAlbums  = 0
         overallNbTracks  = 0
         overallNbArtists = len(db)
 
-        # The 'artists' file contains all known artists with their index, the 'files' file contains the file structure of the root path
-        allArtists = sorted([(artist, str(indexArtist), len(db[artist])) for indexArtist, artist in enumerate(db)], key = lambda a: a[0])
-        pickleSave(os.path.join(libPath, 'files'),   newLibrary)
-        pickleSave(os.path.join(libPath, 'artists'), allArtists)
+        for artist, albums in db.iteritems():
+            overallNbAlbums += len(albums)
 
-        for (artist, indexArtist, nbAlbums) in allArtists:
-            artistPath       = os.path.join(libPath, indexArtist)
-            overallNbAlbums += nbAlbums
-            os.mkdir(artistPath)
+            if artist in storedArtists:
+                artistId = storedArtists.pop(artist)
+                connection.execute('UPDATE artists SET nbAlbums = ? WHERE id = ? AND nbAlbums != ?', (len(albums), artistId, len(albums)))
+            else:
+                artistId = connection.execute('INSERT INTO artists (name, nbAlbums) VALUES (?, ?)', (artist, len(albums))).lastrowid
 
-            albums = []
-            for index, (name, tracks) in enumerate(db[artist].iteritems()):
-                length           = sum([track.getLength() for track in tracks])
+            for name, tracks in albums.iteritems():
+                albumId          = storedAlbums.pop((artistId, name), None)
                 overallNbTracks += len(tracks)
 
-                albums.append((name, str(index), len(tracks), length))
-                pickleSave(os.path.join(artistPath, str(index)), sorted(tracks, key = lambda track: track.getNumber()))
+                if albumId is not None and storedFiles[albumId] == dict([(track.getFilePath(), mTimes[track.getFilePath()]) for track in tracks]):
+                    continue
+
+                length = sum([track.getLength() for track in tracks])
+
+                if albumId is None:
+                    albumId = connection.execute(DB_INSERT_ALBUM, (artistId, name, tracks[0].getAlbum(), tracks[0].getDiscNumber(), len(tracks), length)).lastrowid
+                else:
+                    connection.execute('UPDATE albums SET nbTracks = ?, length = ? WHERE id = ?', (len(tracks), length, albumId))
+                    connection.execute('DELETE FROM tracks WHERE album = ?', (albumId,))
+
+                connection.executemany('INSERT INTO tracks (album, directory, filename, mtime, number, tags) VALUES (?, ?, ?, ?, ?, ?)',
+                                       [(albumId,) + os.path.split(track.getFilePath()) + (mTimes[track.getFilePath()], track.getNumber(), track.serialize())
+                                        for track in sorted(tracks, key = lambda track: track.getNumber())])
 
-            albums.sort(cmp = lambda a1, a2: cmp(db[artist][a1[0]][0], db[artist][a2[0]][0]))
-            pickleSave(os.path.join(artistPath, 'albums'), albums)
             progress.pulse()
             yield True
 
+        # Remove albums and artists that do not exist anymore
+        for albumId in storedAlbums.itervalues():
+            connection.execute('DELETE FROM tracks WHERE album = ?', (albumId,))
+            connection.execute('DELETE FROM albums WHERE id = ?',    (albumId,))
+
+        connection.executemany('DELETE FROM artists WHERE id = ?', [(artistId,) for artistId in storedArtists.itervalues()])
+
+        connection.commit()
+
+        # Files that are not in the library anymore do not need to remain in the tag cache, which is saved now that it has been filled
+        media.tagCache.remove([file for files in storedFiles.itervalues() for file in files if file not in mTimes])
+        media.tagCache.save()
+
         self.libraries[libName] = (path, overallNbArtists, overallNbAlbums, overallNbTracks)
         self.fillLibraryList()
         if creation:
@@ -341,7 +742,8 @@ class Library(modules.Module):
                 * The list 'paths' if it is not None
                 * The currently selected rows if 'paths' is None
         """
-        tracks = []
+        tracks     = []
+        connection = self.__getDatabase(self.currLib)
 
         if paths is None:
             paths = tree.getSelectedPaths()
@@ -351,10 +753,9 @@ class Library(modules.Module):
             if row[ROW_TYPE] == TYPE_TRACK:
                 tracks.append(row[ROW_TAGS])
             elif row[ROW_TYPE] == TYPE_ALBUM:
-                tracks.extend(pickleLoad(row[ROW_FULLPATH]))
+                tracks.extend([media.track.unserialize(tags) for (tags,) in connection.execute(DB_SELECT_ALBUM_TRACKS, (int(row[ROW_FULLPATH]),))])
             elif row[ROW_TYPE] == TYPE_ARTIST:
-                for album in pickleLoad(os.path.join(row[ROW_FULLPATH], 'albums')):
-                    tracks.extend(pickleLoad(os.path.join(row[ROW_FULLPATH], album[ALB_INDEX])))
+                tracks.extend([media.track.unserialize(tags) for (tags,) in connection.execute(DB_SELECT_ARTIST_TRACKS, (int(row[ROW_FULLPATH]),))])
             elif row[ROW_TYPE] == TYPE_HEADER:
                 for path in xrange(currPath[0]+1, sys.maxint):
                     if not tree.isValidPath(path):
@@ -364,8 +765,7 @@ class Library(modules.Module):
                     if row[ROW_TYPE] == TYPE_HEADER:
                         break
 
-                    for album in pickleLoad(os.path.join(row[ROW_FULLPATH], 'albums')):
-                        tracks.extend(pickleLoad(os.path.join(row[ROW_FULLPATH], album[ALB_INDEX])))
+                    tracks.extend([media.track.unserialize(tags) for (tags,) in connection.execute(DB_SELECT_ARTIST_TRACKS, (int(row[ROW_FULLPATH]),))])
 
         return tracks
 
@@ -432,7 +832,7 @@ class Library(modules.Module):
 
         # Refresh the library
         refresh = gtk.ImageMenuItem(gtk.STOCK_REFRESH)
-        refresh.connect('activate', lambda widget: idle_add(self.refreshLibrary(None, self.currLib, self.libraries[self.currLib][LIB_PATH]).next))
+        refresh.connect('activate', lambda widget: idle_add(self.__runGenerator, self.refreshLibrary(None, self.currLib, self.libraries[self.currLib][LIB_PATH])))
         popup.append(refresh)
 
         # Randomness
@@ -460,18 +860,17 @@ class Library(modules.Module):
     def loadLibrary(self, tree, name):
         """ Load the given library """
         rows     = []
-        path     = os.path.join(ROOT_PATH, name)
         prevChar = ''
 
         # Make sure the version number is the good one
-        if not os.path.exists(os.path.join(path, 'VERSION_%u' % VERSION)):
+        if not self.__isUpToDate(name):
             logger.error('[%s] Version number does not match, loading of library "%s" aborted' % (MOD_NAME, name))
             error = _('This library is deprecated, please refresh it.')
-            tree.replaceContent([(consts.icoError, error, TYPE_NONE, None, None)])
+            tree.replaceContent([(consts.icoError, None, error, TYPE_NONE, None, None)])
             return
 
         # Create the rows, with alphabetical header if needed
-        for artist in pickleLoad(os.path.join(path, 'artists')):
+        for artist in self.__getDatabase(name).execute(DB_SELECT_ARTISTS):
 
             if len(artist[ART_NAME]) != 0: currChar = unicode(artist[ART_NAME], errors='replace')[0]
             else:                          currChar = prevChar
@@ -481,7 +880,7 @@ class Library(modules.Module):
                 if currChar.isdigit(): rows.append((None, None, '<b>0 - 9</b>',         TYPE_HEADER, None, None))
                 else:                  rows.append((None, None, '<b>%s</b>' % currChar, TYPE_HEADER, None, None))
 
-            rows.append((consts.icoDir, None, cgi.escape(artist[ART_NAME]), TYPE_ARTIST, os.path.join(path, artist[ART_INDEX]), None))
+            rows.append((consts.icoDir, None, cgi.escape(artist[ART_NAME]), TYPE_ARTIST, str(artist[ART_INDEX]), None))
 
         # Insert all rows, and then add a fake child to each artist
         tree.replaceContent(rows)
@@ -492,9 +891,8 @@ class Library(modules.Module):
 
     def loadAlbums(self, tree, node, fakeChild):
         """ Initial load of all albums of the given node, assuming it is of type TYPE_ARTIST """
-        allAlbums = pickleLoad(os.path.join(tree.getItem(node, ROW_FULLPATH), 'albums'))
-        path      = tree.getItem(node, ROW_FULLPATH)
-        rows      = [(consts.icoMediaDir, '[%s]' % tools.sec2str(album[ALB_LENGTH], True), '%s' % cgi.escape(album[ALB_NAME]), TYPE_ALBUM, os.path.join(path, album[ALB_INDEX]), None) for album in allAlbums]
+        allAlbums = self.__getDatabase(self.currLib).execute(DB_SELECT_ALBUMS, (int(tree.getItem(node, ROW_FULLPATH)),))
+        rows      = [(consts.icoMediaDir, '[%s]' % tools.sec2str(album[ALB_LENGTH], True), '%s' % cgi.escape(album[ALB_NAME]), TYPE_ALBUM, str(album[ALB_INDEX]), None) for album in allAlbums]
 
         # Add all the rows, and then add a fake child to each of them
         tree.freeze_child_notify()
@@ -507,7 +905,7 @@ class Library(modules.Module):
 
     def loadTracks(self, tree, node, fakeChild):
         """ Initial load of all tracks of the given node, assuming it is of type TYPE_ALBUM """
-        allTracks = pickleLoad(tree.getItem(node, ROW_FULLPATH))
+        allTracks = [media.track.unserialize(tags) for (tags,) in self.__getDatabase(self.currLib).execute(DB_SELECT_ALBUM_TRACKS, (int(tree.getItem(node, ROW_FULLPATH)),))]
         rows      = [(consts.icoMediaFile, None, '%02u. %s' % (track.getNumber(), cgi.escape(track.getTitle())), TYPE_TRACK, track.getFilePath(), track) for track in allTracks]
 
         tree.appendRows(rows, node)
@@ -542,7 +940,7 @@ class Library(modules.Module):
         """ A key has been pressed """
         keyname = gtk.gdk.keyval_name(event.keyval)
 
-        if keyname == 'F5':       idle_add(self.refreshLibrary(None, self.currLib, self.libraries[self.currLib][LIB_PATH]).next)
+        if keyname == 'F5':       idle_add(self.__runGenerator, self.refreshLibrary(None, self.currLib, self.libraries[self.currLib][LIB_PATH]))
         elif keyname == 'plus':   tree.expandRows()
         elif keyname == 'Left':   tree.collapseRows()
         elif keyname == 'Right':  tree.expandRows()
@@ -603,6 +1001,12 @@ class Library(modules.Module):
             prefs.set(__name__, 'libraries',  self.libraries)
             self.removeAllExplorers()
 
+            for name in self.watchers.keys():
+                self.__stopWatcher(name)
+
+            for name in self.databases.keys():
+                self.__closeDatabase(name)
+
 
     # --== Configuration ==--
 
@@ -641,7 +1045,7 @@ class Library(modules.Module):
     def onRefresh(self, btn):
         """ Refresh the first selected library """
         name = self.cfgList.getSelectedRows()[0][0]
-        idle_add(self.refreshLibrary(self.cfgWindow, name, self.libraries[name][LIB_PATH]).next)
+        idle_add(self.__runGenerator, self.refreshLibrary(self.cfgWindow, name, self.libraries[name][LIB_PATH]))
 
 
     def onAddLibrary(self, btn):
@@ -650,7 +1054,7 @@ class Library(modules.Module):
 
         if result is not None:
             name, path = result
-            idle_add(self.refreshLibrary(self.cfgWindow, name, path, True).next)
+            idle_add(self.__runGenerator, self.refreshLibrary(self.cfgWindow, name, path, True))
 
 
     def renameLibrary(self, oldName, newName):
@@ -660,8 +1064,16 @@ class Library(modules.Module):
 
         oldPath = os.path.join(ROOT_PATH, oldName)
         newPath = os.path.join(ROOT_PATH, newName)
+        self.__closeDatabase(oldName)
         shutil.move(oldPath, newPath)
 
+        if oldName in self.watchers:
+            self.watchers[newName] = self.watchers[oldName]
+            del self.watchers[oldName]
+
+        if self.currLib == oldName:
+            self.currLib = newName
+
         modules.postMsg(consts.MSG_CMD_EXPLORER_RENAME, {'modName': MOD_L10N, 'expName': oldName, 'newExpName': newName})
 
 
@@ -699,6 +1111,8 @@ class Library(modules.Module):
         if questionMsgBox(self.cfgWindow, question, '%s %s' % (_('Your media files will not be removed.'), remark)) == gtk.RESPONSE_YES:
             for row in list.getSelectedRows():
                 # Remove the library from the disk
+                self.__stopWatcher(row[0])
+                self.__closeDatabase(row[0])
                 libPath = os.path.join(ROOT_PATH, row[0])
                 if isdir(libPath):
                     shutil.rmtree(libPath)
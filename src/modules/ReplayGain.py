@@ -16,7 +16,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import gui, modules
+import modules
 
 from tools   import consts
 from gettext import gettext as _
@@ -38,7 +38,7 @@ class ReplayGain(modules.Module):
 
     def handleMsg(self, msg, params):
         """ Handle messages sent to this module """
-        if msg == consts.MSG_EVT_APP_STARTED:
+        if msg in (consts.MSG_EVT_APP_STARTED, consts.MSG_EVT_MOD_LOADED):
             modules.postMsg(consts.MSG_CMD_ENABLE_RG)
-        elif msg in (consts.MSG_EVT_MOD_LOADED, consts.MSG_EVT_MOD_UNLOADED):
-            gui.infoMsgBox(None, _('Restart required'), _('You must restart the application for this modification to take effect.'))
+        elif msg == consts.MSG_EVT_MOD_UNLOADED:
+            modules.postMsg(consts.MSG_CMD_DISABLE_RG)
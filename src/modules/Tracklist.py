@@ -16,11 +16,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import gtk, gui, media, modules, os.path, tools, urllib, __init__
+import gtk, gui, media, modules, os.path, threading, tools, traceback, urllib, __init__
 
 from tools           import consts
 from gettext         import gettext as _
-from gobject         import TYPE_STRING, TYPE_INT, TYPE_PYOBJECT
+from tools.log       import logger
+from gobject         import idle_add, TYPE_PYOBJECT
 from media.track     import Track
 from gui.extListview import ExtListView
 
@@ -29,16 +30,18 @@ MOD_INFO = ('Tracklist', 'Tracklist', '', [], True, False)
 # Create a unique ID for each field of a row in the list
 (
     ROW_ICO,   # Icon drawn in front of the row
-    ROW_NUM,   # Track number
-    ROW_TIT,   # Track title
-    ROW_ART,   # Track artist
-    ROW_ALB,   # Track album
-    ROW_LEN,   # Track length in seconds
-    ROW_GNR,   # Genre
-    ROW_DAT,   # Date
-    ROW_PTH,   # Path to the file
     ROW_TRK    # The Track object
-) = range(10)
+) = range(2)
+
+# Displayed values are not stored in the list, they are retrieved from the Track objects when rows are drawn or sorted
+FIELD_NUM = lambda row: row[ROW_TRK].getNumber()         # Track number
+FIELD_TIT = lambda row: row[ROW_TRK].getTitle()          # Track title
+FIELD_ART = lambda row: row[ROW_TRK].getArtist()         # Track artist
+FIELD_ALB = lambda row: row[ROW_TRK].getExtendedAlbum()  # Track album
+FIELD_LEN = lambda row: row[ROW_TRK].getLength()         # Track length in seconds
+FIELD_GNR = lambda row: row[ROW_TRK].getGenre()          # Genre
+FIELD_DAT = lambda row: row[ROW_TRK].getDate()           # Date
+FIELD_PTH = lambda row: row[ROW_TRK].getURI()            # Path to the file
 
 # Create a unique ID for each column that the user can actually see
 (
@@ -53,6 +56,9 @@ MOD_INFO = ('Tracklist', 'Tracklist', '', [], True, False)
 ) = range(8)
 
 
+# Number of tracks announced to other modules (e.g., to prefetch covers) each time the current track changes
+NB_UPCOMING_TRACKS = 3
+
 PREFS_DEFAULT_REPEAT_STATUS = False
 PREFS_DEFAULT_COLUMNS_VISIBILITY = { COL_TRCK_NUM : True,
                                      COL_TITLE    : True,
@@ -101,17 +107,22 @@ class Tracklist(modules.Module):
         # 'columns-visibility' may be broken, we should not use it (#311293)
         visible = tools.prefs.get(__name__, 'columns-visibility-2', PREFS_DEFAULT_COLUMNS_VISIBILITY)
 
-        columns = (('#',         [(pixbufRdr, gtk.gdk.Pixbuf), (txtRRdr, TYPE_INT)], (ROW_NUM, ROW_TIT),                            False, visible[COL_TRCK_NUM]),
-                   (_('Title'),  [(txtLRdr, TYPE_STRING)],                           (ROW_TIT,),                                    True,  visible[COL_TITLE]),
-                   (_('Artist'), [(txtLRdr, TYPE_STRING)],                           (ROW_ART, ROW_ALB, ROW_NUM, ROW_TIT),          True,  visible[COL_ARTIST]),
-                   (_('Album'),  [(txtLRdr, TYPE_STRING)],                           (ROW_ALB, ROW_NUM, ROW_TIT),                   True,  visible[COL_ALBUM]),
-                   (_('Length'), [(txtRRdr, TYPE_INT)],                              (ROW_LEN,),                                    False, visible[COL_LENGTH]),
-                   (_('Genre'),  [(txtLRdr, TYPE_STRING)],                           (ROW_GNR, ROW_ART, ROW_ALB, ROW_NUM, ROW_TIT), False, visible[COL_GENRE]),
-                   (_('Date'),   [(txtLRdr, TYPE_INT)],                              (ROW_DAT, ROW_ART, ROW_ALB, ROW_NUM, ROW_TIT), False, visible[COL_DATE]),
-                   (_('Path'),   [(txtLRdr, TYPE_STRING)],                           (ROW_PTH,),                                    False, visible[COL_PATH]),
-                   (None,        [(None, TYPE_PYOBJECT)],                            (None,),                                       False, False))
+        columns = (('#',         [(pixbufRdr, gtk.gdk.Pixbuf), (txtRRdr, None)], (FIELD_NUM, FIELD_TIT),                                  False, visible[COL_TRCK_NUM]),
+                   (_('Title'),  [(txtLRdr, None)],                              (FIELD_TIT,),                                            True,  visible[COL_TITLE]),
+                   (_('Artist'), [(txtLRdr, None)],                              (FIELD_ART, FIELD_ALB, FIELD_NUM, FIELD_TIT),            True,  visible[COL_ARTIST]),
+                   (_('Album'),  [(txtLRdr, None)],                              (FIELD_ALB, FIELD_NUM, FIELD_TIT),                       True,  visible[COL_ALBUM]),
+                   (_('Length'), [(txtRRdr, None)],                              (FIELD_LEN,),                                            False, visible[COL_LENGTH]),
+                   (_('Genre'),  [(txtLRdr, None)],                              (FIELD_GNR, FIELD_ART, FIELD_ALB, FIELD_NUM, FIELD_TIT), False, visible[COL_GENRE]),
+                   (_('Date'),   [(txtLRdr, None)],                              (FIELD_DAT, FIELD_ART, FIELD_ALB, FIELD_NUM, FIELD_TIT), False, visible[COL_DATE]),
+                   (_('Path'),   [(txtLRdr, None)],                              (FIELD_PTH,),                                            False, visible[COL_PATH]),
+                   (None,        [(None, TYPE_PYOBJECT)],                        (None,),                                                 False, False))
 
         self.list = ExtListView(columns, sortable=True, dndTargets=consts.DND_TARGETS.values(), useMarkup=False, canShowHideColumns=True)
+
+        # Text is provided on demand, only for the rows being drawn
+        for (colIndex, renderer, field) in ((0, txtRRdr, FIELD_NUM), (1, txtLRdr, FIELD_TIT), (2, txtLRdr, FIELD_ART), (3, txtLRdr, FIELD_ALB),
+                                            (5, txtLRdr, FIELD_GNR), (6, txtLRdr, FIELD_DAT), (7, txtLRdr, FIELD_PTH)):
+            self.list.get_column(colIndex).set_cell_data_func(renderer, self.fmtField, field)
         self.list.get_column(4).set_cell_data_func(txtRRdr, self.fmtLength)
 #        self.list.enableDNDReordering()
         wTree.get_widget('scrolled-tracklist').add(self.list)
@@ -135,9 +146,10 @@ class Tracklist(modules.Module):
 	gui.errorMsgBox(self.window, _('Operação de Tira Led'), _('Sem deletar a lista dos irmão!'))
 
 
-    def getAllFiles(self):                  return [row[ROW_TRK].getFilePath() for row in self.list.iterAllRows()]
-    def getAllTracks(self):                 return [row[ROW_TRK] for row in self.list.iterAllRows()]
-    def fmtLength(self, col, cll, mdl, it): cll.set_property('text', tools.sec2str(mdl.get_value(it, ROW_LEN)))
+    def getAllFiles(self):                         return [row[ROW_TRK].getFilePath() for row in self.list.iterAllRows()]
+    def getAllTracks(self):                        return [row[ROW_TRK] for row in self.list.iterAllRows()]
+    def fmtField(self, col, cll, mdl, it, field): cll.set_property('text', str(field(mdl[it])))
+    def fmtLength(self, col, cll, mdl, it):        cll.set_property('text', tools.sec2str(FIELD_LEN(mdl[it])))
 
 
     def __getNextTrackIdx(self):
@@ -148,6 +160,25 @@ class Tracklist(modules.Module):
         return -1
 
 
+    def __getNextPlayableTrackIdx(self):
+        """ Return the index of the next track not flagged as erroneous, or -1 if there is none """
+        if not self.list.hasMark():
+            return -1
+
+        currIdx = self.list.getMark()
+
+        if self.btnRepeat.get_active(): nbTracks = len(self.list)
+        else:                           nbTracks = len(self.list) - 1 - currIdx
+
+        for i in xrange(nbTracks):
+            currIdx = (currIdx + 1) % len(self.list)
+
+            if self.list.getItem(currIdx, ROW_ICO) != consts.icoError:
+                return currIdx
+
+        return -1
+
+
     def __getPreviousTrackIdx(self):
         """ Return the index of the previous track, or -1 if there is none """
         if self.list.hasMark():
@@ -156,6 +187,22 @@ class Tracklist(modules.Module):
         return -1
 
 
+    def __getUpcomingTracks(self):
+        """ Return the tracks that are going to be played after the current one, at most NB_UPCOMING_TRACKS of them """
+        tracks = []
+        where  = self.list.getMark()
+
+        for i in xrange(min(NB_UPCOMING_TRACKS, len(self.list) - 1)):
+            where += 1
+            if where == len(self.list):
+                if not self.btnRepeat.get_active():
+                    break
+                where = 0
+            tracks.append(self.list.getItem(where, ROW_TRK))
+
+        return tracks
+
+
     def jumpToNext(self):
         """ Jump to the next track, if any """
         where = self.__getNextTrackIdx()
@@ -181,32 +228,28 @@ class Tracklist(modules.Module):
         modules.postMsg(consts.MSG_EVT_NEW_TRACK,   {'track': self.list.getRow(trackIdx)[ROW_TRK]})
         modules.postMsg(consts.MSG_EVT_TRACK_MOVED, {'hasPrevious': self.__getPreviousTrackIdx() != -1, 'hasNext': self.__getNextTrackIdx() != -1})
 
+        upcomingTracks = self.__getUpcomingTracks()
+        if len(upcomingTracks) != 0:
+            modules.postMsg(consts.MSG_EVT_UPCOMING_TRACKS, {'tracks': upcomingTracks})
+
 
     def onTrackEnded(self, withError):
         """ The current track has ended, jump to the next one if any """
-        currIdx = self.list.getMark()
-
         # If an error occurred with the current track, flag it as such
         if withError:
-            self.list.setItem(currIdx, ROW_ICO, consts.icoError)
+            self.list.setItem(self.list.getMark(), ROW_ICO, consts.icoError)
 
-        # Find the next 'playable' track (not already flagged)
-        if self.btnRepeat.get_active(): nbTracks = len(self.list)
-        else:                           nbTracks = len(self.list) - 1 - currIdx
-
-        for i in xrange(nbTracks):
-            currIdx = (currIdx + 1) % len(self.list)
-
-            if self.list.getItem(currIdx, ROW_ICO) != consts.icoError:
-                self.jumpTo(currIdx)
-                return
-
-        modules.postMsg(consts.MSG_CMD_STOP)
+        where = self.__getNextPlayableTrackIdx()
+        if where != -1: self.jumpTo(where)
+        else:           modules.postMsg(consts.MSG_CMD_STOP)
 
 
     def onBufferingNeeded(self):
-        """ The current track is close to its end, so we try to buffer the next one to avoid gaps """
-        where = self.__getNextTrackIdx()
+        """
+            The current track is close to its end, so we try to buffer the next one to avoid gaps
+            This must be the track onTrackEnded() is going to jump to, since the player may already be playing it (e.g., when crossfading)
+        """
+        where = self.__getNextPlayableTrackIdx()
         if where != -1:
             modules.postMsg(consts.MSG_CMD_BUFFER, {'uri': self.list.getItem(where, ROW_TRK).getURI()})
 
@@ -214,15 +257,65 @@ class Tracklist(modules.Module):
     def insert(self, tracks, position=None):
         """ Insert some tracks in the tracklist, append them if position is None """
         self.previousTracklist = [row[ROW_TRK] for row in self.list.getAllRows()]
-        rows = [[consts.icoNull, track.getNumber(), track.getTitle(), track.getArtist(), track.getExtendedAlbum(),
-                    track.getLength(), track.getGenre(), track.getDate(), track.getURI(), track] for track in tracks]
+        rows = [[consts.icoNull, track] for track in tracks]
 
-        for row in rows:
-            self.playtime += row[ROW_LEN]
+        for track in tracks:
+            self.playtime += track.getLength()
 
         self.list.insertRows(rows, position)
 
 
+    def insertStream(self, stream, position=None):
+        """
+            Insert the tracks yielded by the given stream (see media.iterTracks()), append them if position is None
+            The stream is consumed by a separate thread, so that walking directories and parsing files never blocks the GTK main loop
+        """
+        previousTracklist = [row[ROW_TRK] for row in self.list.getAllRows()]
+
+        thread = threading.Thread(target=self.__consumeStream, args=(stream, position, previousTracklist))
+        thread.setDaemon(True)
+        thread.start()
+
+
+    def __consumeStream(self, stream, position, previousTracklist):
+        """
+            Thread body: consume the given stream, the GTK main loop inserts each batch as soon as it is available, and puts
+            the inserted rows in their final order once the stream has ended
+        """
+        allTracks = None
+
+        try:
+            for tracks, allTracks in stream:
+                if allTracks is None:
+                    idle_add(self.insert, tracks, position)
+                    if position is not None:
+                        position += len(tracks)
+        except:
+            logger.error('[%s] Unable to load the tracks\n\n%s' % (MOD_INFO[modules.MODINFO_NAME], traceback.format_exc()))
+
+        if allTracks is not None:
+            idle_add(self.__reorderStream, allTracks, previousTracklist)
+
+
+    def __reorderStream(self, allTracks, previousTracklist):
+        """ Put the streamed tracks in the order given by allTracks, once they have all been inserted """
+        self.previousTracklist = previousTracklist
+
+        # Other rows may have been added/removed in the meantime, so we find again where the streamed tracks are
+        positions = dict([(id(row[ROW_TRK]), index) for index, row in enumerate(self.list.iterAllRows())])
+        inserted  = [track for track in allTracks if id(track) in positions]
+        slots     = sorted([positions[id(track)] for track in inserted])
+        order     = range(len(self.list))
+
+        for slot, track in zip(slots, inserted):
+            order[slot] = positions[id(track)]
+
+        if order != range(len(self.list)):
+            self.list.reorder(order)
+
+        return False
+
+
     def set(self, tracks, playNow):
         """ Replace the tracklist, clear it if tracks is None """
         self.playtime     = 0
@@ -271,7 +364,7 @@ class Tracklist(modules.Module):
     def removeSelection(self, invert=False):
         """ Remove the selected tracks if invert is False / the unselected tracks if invert is True """
         hadMark                = self.list.hasMark()
-        selectionPlaytime      = sum([row[ROW_LEN] for row in self.list.iterSelectedRows()])
+        selectionPlaytime      = sum([row[ROW_TRK].getLength() for row in self.list.iterSelectedRows()])
         self.previousTracklist = [row[ROW_TRK] for row in self.list.getAllRows()]
 
         if invert:
@@ -374,6 +467,7 @@ class Tracklist(modules.Module):
         elif msg == consts.MSG_EVT_NEED_BUFFER:                              self.onBufferingNeeded()
         elif msg == consts.MSG_CMD_TRACKLIST_CLR:                            self.set(None, False)
 #        elif msg == consts.MSG_CMD_TRACKLIST_SET:                            self.tiraLed()
+        elif msg == consts.MSG_CMD_TRACKLIST_ADD and 'stream' in params:     self.insertStream(params['stream'])
         elif msg == consts.MSG_CMD_TRACKLIST_ADD:                            self.insert(params['tracks'])
         elif msg == consts.MSG_CMD_TRACKLIST_SHUFFLE:                        self.shuffleTracklist()
         elif msg == consts.MSG_CMD_TOGGLE_PAUSE and not self.list.hasMark(): self.jumpTo(0)
@@ -455,17 +549,17 @@ class Tracklist(modules.Module):
 
         dropInfo = list.get_dest_row_at_pos(x, y)
 
+        if dropInfo is None: position = None
+        else:                position = dropInfo[0][0]
+
         # A list of filenames, without 'file://' at the beginning
         if dndId == consts.DND_DAP_URI:
-            tracks = media.getTracks([urllib.url2pathname(uri) for uri in dragData.data.split()])
+            self.insertStream(media.iterTracks([urllib.url2pathname(uri) for uri in dragData.data.split()]), position)
         # A list of filenames starting with 'file://'
         elif dndId == consts.DND_URI:
-            tracks = media.getTracks([urllib.url2pathname(uri)[7:] for uri in dragData.data.split()])
+            self.insertStream(media.iterTracks([urllib.url2pathname(uri)[7:] for uri in dragData.data.split()]), position)
         # A list of tracks
         elif dndId == consts.DND_DAP_TRACKS:
-            tracks = [media.track.unserialize(serialTrack) for serialTrack in dragData.data.split('\n')]
-
-        if dropInfo is None: self.insert(tracks)
-        else:                self.insert(tracks, dropInfo[0][0])
+            self.insert([media.track.unserialize(serialTrack) for serialTrack in dragData.data.split('\n')], position)
 
         context.finish(True, False, time)
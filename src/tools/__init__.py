@@ -16,30 +16,150 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import consts, cPickle, gtk, gtk.glade, os
+import consts, cPickle, gtk, gtk.glade, os, threading
 
+from stat        import S_ISDIR, S_ISREG
+from collections import OrderedDict
 
-__dirCache = {}
+# The scandir module is optional, it provides the type of entries without calling os.stat()
+try:    import scandir
+except: scandir = None
 
-def listDir(directory, listHiddenFiles=False):
+
+class DirEntry:
+    """ An entry of a directory, as returned by listDir() """
+
+    def __init__(self, name, path, isDir, isFile, stat):
+        """ Constructor """
+        self.name   = name
+        self.path   = path
+        self.isDir  = isDir
+        self.isFile = isFile
+        self.stat   = stat   # The result of os.stat(), None if it has not been requested or if it failed
+
+
+def __readDir(directory):
+    """ Return a list of tuples (name, isDir, isFile, stat) with the given directory content, stat is None if it was not needed """
+    if not os.access(directory, os.R_OK | os.X_OK):
+        return []
+
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(), entry.is_file(), None) for entry in scandir.scandir(directory)]
+
+    contents = []
+    for name in os.listdir(directory):
+        try:
+            fileStat = os.stat(os.path.join(directory, name))
+            contents.append((name, S_ISDIR(fileStat.st_mode), S_ISREG(fileStat.st_mode), fileStat))
+        except:
+            # For instance, a broken symbolic link
+            contents.append((name, False, False, None))
+
+    return contents
+
+
+# The content of the most recently listed directories is cached
+DIR_CACHE_MAX_DIRS  = 2048    # Maximum number of cached directories
+DIR_CACHE_MAX_NAMES = 100000  # Maximum number of cached names, all directories included
+
+__dirCache      = OrderedDict()     # Least recently used directories come first
+__dirCacheMutex = threading.Lock()  # Directories may be listed by several threads at the same time
+__dirCacheStats = [0, 0]            # Number of hits and misses
+__dirCacheNames = [0]               # Number of cached names, all directories included
+
+
+def __cacheDir(directory, mTime, list):
+    """ Put the given directory content in the cache, evict the least recently used ones if needed, must be called with the mutex held """
+    if directory in __dirCache:
+        __dirCacheNames[0] -= len(__dirCache.pop(directory)[1])
+
+    __dirCache[directory] = (mTime, list)
+    __dirCacheNames[0]   += len(list)
+
+    while len(__dirCache) > 1 and (len(__dirCache) > DIR_CACHE_MAX_DIRS or __dirCacheNames[0] > DIR_CACHE_MAX_NAMES):
+        __dirCacheNames[0] -= len(__dirCache.popitem(False)[1][1])
+
+
+def invalidateDirCache(directory=None, recursive=False):
+    """
+        Remove the given directory from the cache, as well as all its subdirectories if recursive is True
+        The whole cache is emptied if directory is None
+    """
+    __dirCacheMutex.acquire()
+
+    if directory is None:
+        __dirCache.clear()
+        __dirCacheNames[0] = 0
+    else:
+        prefix = os.path.join(directory, '')
+        for cachedDir in __dirCache.keys():
+            if cachedDir == directory or (recursive and cachedDir.startswith(prefix)):
+                __dirCacheNames[0] -= len(__dirCache.pop(cachedDir)[1])
+
+    __dirCacheMutex.release()
+
+
+def getDirCacheStats():
+    """ Return a tuple (hits, misses, number of cached directories, number of cached names) """
+    __dirCacheMutex.acquire()
+    stats = (__dirCacheStats[0], __dirCacheStats[1], len(__dirCache), __dirCacheNames[0])
+    __dirCacheMutex.release()
+
+    return stats
+
+
+def listDir(directory, listHiddenFiles=False, withStat=False):
     """
-        Return a list of tuples (filename, path) with the given directory content
+        Return a list of DirEntry objects with the given directory content, the result of os.stat() is provided only if withStat is True
+        Directories are never stat'ed on purpose, so their result of os.stat() may be None even if withStat is True
+        Only names and types are cached, since files may be modified without any change to the modification time of the directory
         The dircache module sorts the list of files, and either it's not needed or it's not sorted the way we want
     """
+    if os.path.exists(directory): mTime = os.stat(directory).st_mtime
+    else:                         mTime = 0
+
+    __dirCacheMutex.acquire()
+
     if directory in __dirCache: cachedMTime, list = __dirCache[directory]
     else:                       cachedMTime, list = None, None
 
-    if os.path.exists(directory): mTime = os.stat(directory).st_mtime
-    else:                         mTime = 0
+    if mTime == cachedMTime:
+        # Move it to the end, being now the most recently used directory
+        del __dirCache[directory]
+        __dirCache[directory] = (cachedMTime, list)
+        __dirCacheStats[0]   += 1
+    else:
+        __dirCacheStats[1] += 1
+
+    __dirCacheMutex.release()
 
+    stats = {}
     if mTime != cachedMTime:
-        # Make sure it's readable
-        if os.access(directory, os.R_OK | os.X_OK): list = os.listdir(directory)
-        else:                                       list = []
+        contents = __readDir(directory)
+        list     = [(name, isDir, isFile) for (name, isDir, isFile, fileStat) in contents]
+
+        if withStat:
+            stats = dict([(name, fileStat) for (name, isDir, isFile, fileStat) in contents if fileStat is not None])
+
+        __dirCacheMutex.acquire()
+        __cacheDir(directory, mTime, list)
+        __dirCacheMutex.release()
+
+    entries = []
+    for (name, isDir, isFile) in list:
+        if listHiddenFiles or name[0] != '.':
+            path     = os.path.join(directory, name)
+            fileStat = None
+
+            if withStat and not isDir:
+                if name in stats: fileStat = stats[name]
+                else:
+                    try:    fileStat = os.stat(path)
+                    except: pass
 
-        __dirCache[directory] = (mTime, list)
+            entries.append(DirEntry(name, path, isDir, isFile, fileStat))
 
-    return [(filename, os.path.join(directory, filename)) for filename in list if listHiddenFiles or filename[0] != '.']
+    return entries
 
 
 def sec2str(seconds, alwaysShowHours=False):
@@ -59,16 +179,16 @@ def loadGladeFile(file, root=None):
 
 def pickleLoad(file):
     """ Use cPickle to load the data structure stored in the given file """
-    input = open(file, 'r')
+    input = open(file, 'rb')
     data  = cPickle.load(input)
     input.close()
     return data
 
 
-def pickleSave(file, data):
-    """ Use cPickle to save the data to the given file """
-    output = open(file, 'w')
-    cPickle.dump(data, output)
+def pickleSave(file, data, protocol=0):
+    """ Use cPickle to save the data to the given file (a binary protocol is much faster for large data structures) """
+    output = open(file, 'wb')
+    cPickle.dump(data, output, protocol)
     output.close()
 
 
@@ -79,9 +79,10 @@ fileImgIcon128 = os.path.join(dirPix, 'decibel-audio-player-128.png')
 
 
 # --- Files
-fileLog     = os.path.join(dirLog, 'log')
-filePrefs   = os.path.join(dirCfg, 'prefs.txt')
-fileLicense = os.path.join(dirDoc, 'LICENCE')
+fileLog      = os.path.join(dirLog, 'log')
+filePrefs    = os.path.join(dirCfg, 'prefs.txt')
+fileLicense  = os.path.join(dirDoc, 'LICENCE')
+fileTagCache = os.path.join(dirCfg, 'tag-cache')
 
 
 # --- DBus constants
@@ -158,15 +159,17 @@ DND_TARGETS = {
     MSG_CMD_BUFFER,           # Buffer a file                              Parameters: 'filename'
     MSG_CMD_TOGGLE_PAUSE,     # Toggle play/pause                          Parameters:
     MSG_CMD_ENABLE_EQZ,       # Enable the equalizer                       Parameters:
+    MSG_CMD_DISABLE_EQZ,      # Disable the equalizer                      Parameters:
     MSG_CMD_SET_EQZ_LVLS,     # Set the levels of the 10-bands equalizer   Parameters: 'lvls'
     MSG_CMD_ENABLE_RG,        # Enable ReplayGain                          Parameters:
     MSG_CMD_DISABLE_RG,       # Disable ReplayGain                         Parameters:
+    MSG_CMD_SUBSCRIBE_POS,    # Get the position every 'interval' ms       Parameters: 'module', 'interval' (0 to unsubscribe)
 
     # Tracklist
     MSG_CMD_NEXT,              # Play the next track       Parameters:
     MSG_CMD_PREVIOUS,          # Play the previous track   Parameters:
     MSG_CMD_TRACKLIST_SET,     # Replace tracklist         Parameters: 'tracks', 'playNow'
-    MSG_CMD_TRACKLIST_ADD,     # Extend tracklist          Parameters: 'tracks'
+    MSG_CMD_TRACKLIST_ADD,     # Extend tracklist          Parameters: 'tracks' or 'stream' (see media.iterTracks())
     MSG_CMD_TRACKLIST_CLR,     # Clear tracklist           Parameters:
     MSG_CMD_TRACKLIST_SHUFFLE, # Shuffle the tracklist     Parameters:
 
@@ -186,7 +189,7 @@ DND_TARGETS = {
     MSG_EVT_UNPAUSED,            # Unpaused                                           Parameters:
     MSG_EVT_NEW_TRACK,           # The current track has changed                      Parameters: 'track'
     MSG_EVT_NEED_BUFFER,         # The next track should be buffered                  Parameters:
-    MSG_EVT_TRACK_POSITION,      # New position in the current track                  Parameters: 'seconds'
+    MSG_EVT_TRACK_POSITION,      # New position (sent to subscribers only)            Parameters: 'seconds'
     MSG_EVT_TRACK_ENDED_OK,      # The current track has ended                        Parameters:
     MSG_EVT_TRACK_ENDED_ERROR,   # The current track has ended because of an error    Parameters:
 
@@ -196,6 +199,7 @@ DND_TARGETS = {
     # Tracklist
     MSG_EVT_TRACK_MOVED,      # The position of the current track has changed    Parameters: 'hasPrevious', 'hasNext'
     MSG_EVT_NEW_TRACKLIST,    # A new tracklist has been set                     Parameters: 'tracks', 'playtime'
+    MSG_EVT_UPCOMING_TRACKS,  # These tracks are going to be played next         Parameters: 'tracks'
 
     # Application
     MSG_EVT_APP_QUIT,         # The application is quitting         Parameters:
@@ -210,4 +214,4 @@ DND_TARGETS = {
 
     # End value
     MSG_END_VALUE
-) = range(37)
+) = range(40)
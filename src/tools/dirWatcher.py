@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Ingelrest François (Francois.Ingelrest@gmail.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import gobject, os, threading, traceback
+
+from tools.log import logger
+
+# pyinotify is optional, directories are polled when it is not available
+try:    import pyinotify
+except: pyinotify = None
+
+
+POLL_INTERVAL = 120   # Number of seconds between two scans of the directories when inotify cannot be used
+
+
+class DirWatcher:
+    """
+        Record the files created, modified, and deleted under a given root directory
+        Changes are accumulated until they are retrieved with popChanges()
+    """
+
+    def __init__(self, root):
+        """ Constructor """
+        self.root     = root
+        self.mutex    = threading.Lock()
+        self.ready    = False            # True once the whole tree is being watched
+        self.inSync   = False            # True if all changes since the last call to reset() are known
+        self.stopped  = threading.Event()
+        self.deleted  = set()
+        self.modified = set()
+        self.notifier = None
+        self.ioWatch  = None
+        self.polling  = False            # True if the tree is polled instead of being watched by inotify
+        self.snapshot = None             # The result of the last scan of the tree, when polling
+        self.wakeUp   = threading.Event()
+        self.nbScans  = [0, 0]           # Number of scans requested and done, when polling
+
+
+    def start(self):
+        """ Start watching the root directory, the tree is explored in a separate thread """
+        thread = threading.Thread(target=self.__setup)
+        thread.setDaemon(True)
+        thread.start()
+
+
+    def stop(self):
+        """ Stop watching the root directory """
+        self.stopped.set()
+        self.wakeUp.set()
+
+        if self.ioWatch is not None:
+            gobject.source_remove(self.ioWatch)
+            self.ioWatch = None
+
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+
+    def reset(self):
+        """ Forget all recorded changes, must be called when a complete scan of the root directory is about to start """
+        self.mutex.acquire()
+        self.inSync = self.ready
+        self.deleted.clear()
+        self.modified.clear()
+        self.mutex.release()
+
+
+    def popChanges(self):
+        """
+            Return a tuple (modified, deleted) with the paths recorded since the last call, or None if some changes may have been missed
+            Modified paths may be files or directories (to be explored), deleted paths may be files or directories as well
+            When polling, requestScan() should be called first, so that the most recent changes are not missed
+        """
+        self.mutex.acquire()
+
+        if self.inSync: changes = (self.modified.copy(), self.deleted.copy())
+        else:           changes = None
+
+        self.deleted.clear()
+        self.modified.clear()
+        self.mutex.release()
+
+        return changes
+
+
+    def invalidate(self):
+        """ Some changes may have been missed (e.g., a complete scan of the root directory has been cancelled) """
+        self.mutex.acquire()
+        self.inSync = False
+        self.mutex.release()
+
+
+    def requestScan(self):
+        """
+            When polling, ask the polling thread to scan the tree right now, and return an identifier to be given to isScanDone()
+            Return None if the tree is not polled, recorded changes are then already up to date
+        """
+        if not self.polling or not self.ready:
+            return None
+
+        self.mutex.acquire()
+        self.nbScans[0] += 1
+        scanId           = self.nbScans[0]
+        self.mutex.release()
+
+        self.wakeUp.set()
+
+        return scanId
+
+
+    def isScanDone(self, scanId):
+        """ Return True if the scan requested with the given identifier has been done """
+        self.mutex.acquire()
+        isDone = self.nbScans[1] >= scanId or self.stopped.isSet()
+        self.mutex.release()
+
+        return isDone
+
+
+    def __record(self, path, deleted):
+        """ Record a change on the given path """
+        self.mutex.acquire()
+
+        if deleted:
+            self.modified.discard(path)
+            self.deleted.add(path)
+        else:
+            self.deleted.discard(path)
+            self.modified.add(path)
+
+        self.mutex.release()
+
+
+    def __setup(self):
+        """ Start watching the tree, either with inotify or by polling it """
+        try:
+            if pyinotify is not None: self.__setupInotify()
+            else:                     self.__poll()
+        except:
+            logger.error('[DirWatcher] Unable to watch %s\n\n%s' % (self.root, traceback.format_exc()))
+
+
+    # --== inotify ==--
+
+
+    def __setupInotify(self):
+        """ Add a watch on each directory of the tree, events are then processed by the GTK main loop """
+        mask    = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF
+        manager = pyinotify.WatchManager()
+
+        watches = manager.add_watch(self.root, mask, rec=True, auto_add=True, quiet=True)
+
+        # Failed watches are reported with a negative descriptor (e.g., the maximum number of watches has been reached)
+        if len([wd for wd in watches.itervalues() if wd < 0]) != 0:
+            logger.info('[DirWatcher] Unable to watch all the directories under %s, polling them instead' % self.root)
+            try:    manager.close()
+            except: pass
+            self.__poll()
+        elif not self.stopped.isSet():
+            gobject.idle_add(self.__startNotifier, manager)
+
+
+    def __startNotifier(self, manager):
+        """ Dispatch inotify events from the GTK main loop """
+        if not self.stopped.isSet():
+            self.notifier = pyinotify.Notifier(manager, self.__onInotifyEvent, timeout=0)
+            self.ioWatch  = gobject.io_add_watch(manager.get_fd(), gobject.IO_IN, self.__onInotifyReadable)
+            self.ready    = True
+
+        return False
+
+
+    def __onInotifyReadable(self, fd, condition):
+        """ Some inotify events are available """
+        if self.notifier is not None:
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+        return True
+
+
+    def __onInotifyEvent(self, event):
+        """ Record the change described by the given inotify event """
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.invalidate()
+        elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            self.__record(event.pathname, True)
+        elif event.mask & pyinotify.IN_DELETE_SELF:
+            if event.pathname == self.root:
+                self.__record(event.pathname, True)
+        elif event.mask & pyinotify.IN_CREATE:
+            # A new file is reported when it is closed, but there will be no such event for a new directory
+            if event.dir:
+                self.__record(event.pathname, False)
+        else:
+            self.__record(event.pathname, False)
+
+
+    # --== Polling ==--
+
+
+    def __snapshot(self):
+        """ Return a dictionary path -> modification time for all the files of the tree (new or removed directories show up through their files) """
+        snapshot = {}
+
+        for (directory, subdirs, files) in os.walk(self.root):
+            if self.stopped.isSet():
+                break
+
+            for name in files:
+                path = os.path.join(directory, name)
+                try:    snapshot[path] = os.stat(path).st_mtime
+                except: pass
+
+        return snapshot
+
+
+    def __compareSnapshots(self):
+        """ Scan the tree and record the differences with the previous scan """
+        current = self.__snapshot()
+
+        for path, mTime in current.iteritems():
+            if self.snapshot.get(path, None) != mTime:
+                self.__record(path, False)
+
+        for path in self.snapshot:
+            if path not in current:
+                self.__record(path, True)
+
+        self.snapshot = current
+
+
+    def __poll(self):
+        """ Regularly scan the tree and compare it to the previous scan, scans requested with requestScan() are done right away """
+        self.polling  = True
+        self.snapshot = self.__snapshot()
+        self.ready    = True
+
+        while not self.stopped.isSet():
+            self.wakeUp.wait(POLL_INTERVAL)
+            self.wakeUp.clear()
+            if self.stopped.isSet():
+                break
+
+            # Scans requested from now on will need another pass
+            self.mutex.acquire()
+            scanId = self.nbScans[0]
+            self.mutex.release()
+
+            self.__compareSnapshots()
+
+            self.mutex.acquire()
+            self.nbScans[1] = scanId
+            self.mutex.release()